@@ -2,28 +2,903 @@
 # -*-coding: utf-8 -*-
 
 from types import ModuleType
+from typing import NamedTuple
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit, urljoin
 import time, sys, pathlib, atexit, datetime
+import asyncio
 import subprocess, shlex
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse, importlib.util
-import logging, traceback
-from os import getpid
+import logging, logging.handlers, traceback
+import threading, queue, json
+import heapq, itertools, collections, re
+import sqlite3, zlib, math, socket
+import os, shutil
+from os import getpid, kill
+import signal
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+try:
+  import websocket   # websocket-client, only needed for self.eventsub
+except ImportError:
+  websocket = None
+try:
+  import streamlink   # only needed for the in-process quality check of self.legacy_func
+  from streamlink.plugin import Plugin as StreamlinkPlugin
+except ImportError:
+  streamlink = None
+
+
+# token bucket for the helix rate limit. synced with the Ratelimit-* headers of every response
+class RateLimiter:
+  def __init__(self, limit=800, reserve=0.1) -> None:
+    self.limit = limit   # points per minute
+    self.reserve = reserve   # part of the budget left for token and other helix requests
+    self.tokens = self.capacity()
+    self.updated = time.monotonic()
+    self.blocked_until = 0
+    self.lock = threading.Lock()
+
+  def capacity(self) -> float:
+    return self.limit * (1 - self.reserve)
+
+  # points per second
+  def rate(self) -> float:
+    return self.capacity() / 60
+
+  def refill(self) -> None:
+    now = time.monotonic()
+    self.tokens = min(self.capacity(), self.tokens + (now - self.updated) * self.rate())
+    self.updated = now
+
+  def acquire(self) -> bool:
+    with self.lock:
+      if time.time() < self.blocked_until:
+        return False
+      self.refill()
+      if self.tokens >= 1:
+        self.tokens -= 1
+        return True
+      return False
+
+  def update(self, headers) -> None:
+    with self.lock:
+      self.refill()
+      if 'Ratelimit-Limit' in headers:
+        self.limit = int(headers['Ratelimit-Limit'])
+      if 'Ratelimit-Remaining' in headers:
+        self.tokens = min(self.tokens, int(headers['Ratelimit-Remaining']) - self.limit * self.reserve)
+
+  # too_many_requests : no request until reset time
+  def block(self, reset_time) -> None:
+    with self.lock:
+      self.blocked_until = max(self.blocked_until, reset_time)
+      self.tokens = 0
+
+
+# attribute list of a m3u8 tag. example: '#EXT-X-MEDIA:TYPE=VIDEO,NAME="720p60"' -> {'TYPE': 'VIDEO', 'NAME': '720p60'}
+def m3u8_attributes(line: str) -> dict:
+  return {key: value.strip('"') for key, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', line.split(':', 1)[-1])}
+
+def m3u8_datetime(value: str) -> datetime.datetime:
+  return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+# one stream of a master playlist
+class Variant(NamedTuple):
+  name: str   # quality name without ' (source)'. example: '720p60', 'audio_only'
+  url: str
+  group_id: str
+  bandwidth: int
+  resolution: str   # '1280x720', '' for audio_only
+  frame_rate: float
+  codecs: str
+  source: bool
+
+# variants of a master playlist in the order of the playlist(best first). EXT-X-MEDIA and EXT-X-STREAM-INF are matched by GROUP-ID
+def master_playlist_parser(m3u8: str, base_url='') -> list:
+  media = dict()
+  stream_inf = None
+  variants = []
+  for m3u8_line in m3u8.split('\n'):
+    m3u8_line = m3u8_line.strip()
+    if m3u8_line.startswith('#EXT-X-MEDIA:'):
+      attributes = m3u8_attributes(m3u8_line)
+      if attributes.get('TYPE', 'VIDEO') == 'VIDEO' and 'NAME' in attributes:
+        media[attributes.get('GROUP-ID')] = attributes['NAME']
+        media[None] = attributes['NAME']   # last EXT-X-MEDIA, for EXT-X-STREAM-INF without VIDEO
+    elif m3u8_line.startswith('#EXT-X-STREAM-INF:'):
+      stream_inf = m3u8_attributes(m3u8_line)
+    elif m3u8_line != '' and m3u8_line.startswith('#') is False and stream_inf is not None:
+      group_id = stream_inf.get('VIDEO')
+      name = media.get(group_id, media.get(None))
+      if name is not None:
+        variants.append(Variant(name.replace(' (source)', ''), urljoin(base_url, m3u8_line), group_id or '', int(stream_inf.get('BANDWIDTH', 0)), stream_inf.get('RESOLUTION', ''),
+                                float(stream_inf.get('FRAME-RATE', 0)), stream_inf.get('CODECS', ''), '(source)' in name or group_id == 'chunked'))
+      stream_inf = None
+  return variants
+
+# segments of a media playlist. ad segments are marked like streamlink's --twitch-disable-ads : stitched-ad date range or 'Amazon' title
+def media_playlist_parser(m3u8: str, base_url: str) -> dict:
+  playlist = {'target_duration': 2, 'segments': [], 'endlist': False}
+  sequence = 0
+  title = ''
+  program_time = None
+  ads = []
+  for m3u8_line in m3u8.split('\n'):
+    m3u8_line = m3u8_line.strip()
+    if m3u8_line.startswith('#EXT-X-TARGETDURATION'):
+      playlist['target_duration'] = float(m3u8_line.split(':')[1])
+    elif m3u8_line.startswith('#EXT-X-MEDIA-SEQUENCE'):
+      sequence = int(m3u8_line.split(':')[1])
+    elif m3u8_line.startswith('#EXT-X-DATERANGE'):
+      attributes = m3u8_attributes(m3u8_line)
+      if attributes.get('CLASS') == 'twitch-stitched-ad' or attributes.get('ID', '').startswith('stitched-ad-'):
+        start = m3u8_datetime(attributes['START-DATE'])
+        ads.append((start, start + datetime.timedelta(seconds=float(attributes.get('DURATION', 0)))))
+    elif m3u8_line.startswith('#EXT-X-PROGRAM-DATE-TIME'):
+      program_time = m3u8_datetime(m3u8_line.split(':', 1)[1])
+    elif m3u8_line.startswith('#EXTINF'):
+      title = m3u8_line.split(',', 1)[1] if ',' in m3u8_line else ''
+    elif m3u8_line.startswith('#EXT-X-ENDLIST'):
+      playlist['endlist'] = True
+    elif m3u8_line != '' and m3u8_line.startswith('#') is False:
+      ad = 'Amazon' in title or (program_time is not None and any(start <= program_time < end for start, end in ads))
+      playlist['segments'].append({'sequence': sequence, 'url': urljoin(base_url, m3u8_line), 'ad': ad})
+      sequence += 1
+      title = ''
+      program_time = None
+  return playlist
+
+
+# in-process HLS recorder. every recording shares one thread pool and the keep-alive sessions of TwitchLiveCheck
+class HLSRecorder:
+  def __init__(self, get_session, workers=16, timeout=3.5, attempts=5, live_edge=6, live_restart=False) -> None:
+    self.get_session = get_session
+    self.timeout = timeout
+    self.attempts = attempts   # same as --stream-segment-attempts
+    self.live_edge = live_edge   # same as --hls-live-edge
+    self.live_restart = live_restart   # same as --hls-live-restart
+    self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hls')
+    self.schedule_heap = []
+    self.counter = itertools.count()
+    self.wakeup = threading.Condition()
+    threading.Thread(target=self.schedule_loop, name='hls_schedule', daemon=True).start()
+
+  def record(self, url, file_path, resolve=None) -> 'HLSRecording':
+    recording = HLSRecording(self, url, file_path, resolve)
+    self.schedule(recording, 0)
+    return recording
+
+  def schedule(self, recording, delay) -> None:
+    with self.wakeup:
+      heapq.heappush(self.schedule_heap, (time.monotonic() + delay, next(self.counter), recording))
+      self.wakeup.notify()
+
+  # reload the playlists of every recording on time, with one thread
+  def schedule_loop(self) -> None:
+    while True:
+      with self.wakeup:
+        while self.schedule_heap == [] or self.schedule_heap[0][0] > time.monotonic():
+          self.wakeup.wait(None if self.schedule_heap == [] else self.schedule_heap[0][0] - time.monotonic())
+        recording = heapq.heappop(self.schedule_heap)[2]
+      self.pool.submit(recording.reload)
+
+  def download(self, url) -> bytes:
+    for _ in range(self.attempts):
+      try:
+        res = self.get_session(url).get(url, timeout= self.timeout)
+        if res.status_code == requests.codes.ok:
+          return res.content
+      except requests.exceptions.RequestException:
+        pass
+    return None
+
+
+# streamlink processes started in advance. each one waits for its arguments on stdin with streamlink already imported
+class RecorderPool:
+  def __init__(self, command: list, size: int, warmup=2, failure_max=3) -> None:
+    self.command = command
+    self.size = size
+    self.warmup = warmup   # (seconds) a new worker joins the pool when it is still running after this
+    self.failure_max = failure_max   # the pool stops when this many workers exit during warmup. example: streamlink is not importable
+    self.failures = 0
+    self.idle = queue.Queue()
+    self.refill_event = threading.Event()
+    threading.Thread(target=self.refill_loop, name='recorder_pool', daemon=True).start()
+
+  # one worker at a time, so many streams going live at once don't start many interpreters at once
+  def refill_loop(self) -> None:
+    while self.failures < self.failure_max:
+      if self.idle.qsize() >= self.size:
+        self.refill_event.wait()
+        self.refill_event.clear()
+        continue
+      proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, universal_newlines=True)
+      try:
+        proc.wait(timeout=self.warmup)
+        self.failures += 1
+      except subprocess.TimeoutExpired:
+        self.failures = 0
+        self.idle.put(proc)
+
+  # hand the streamlink arguments to an idle worker. None if there is no idle worker
+  def launch(self, args: list) -> subprocess.Popen:
+    proc = None
+    while proc is None:
+      try:
+        proc = self.idle.get_nowait()
+      except queue.Empty:
+        break
+      if proc.poll() is not None:
+        proc = None
+    self.refill_event.set()
+    if proc is None:
+      return None
+    try:
+      proc.stdin.write(json.dumps([str(arg) for arg in args]) + '\n')
+      proc.stdin.close()
+    except OSError:
+      return None
+    return proc
+
+  # idle workers exit when their stdin is closed
+  def close(self) -> None:
+    self.failures = self.failure_max
+    self.refill_event.set()
+    while True:
+      try:
+        self.idle.get_nowait().stdin.close()
+      except queue.Empty:
+        break
+      except OSError:
+        pass
+
+# entry point of the RecorderPool workers
+def recorder_worker() -> None:
+  import streamlink_cli.main   # the slow part of a streamlink start
+  import streamlink.plugins.twitch
+  line = sys.stdin.readline()
+  if line == '':
+    sys.exit(0)
+  sys.argv = json.loads(line)
+  streamlink_cli.main.main()
+
+
+# remux and archive of finished recordings on a few low priority threads. a job is saved until it is done, so it runs again after a restart
+class PostProcessor:
+  def __init__(self, remux: bool, archive_root, save_jobs, workers=1, nice=10, ionice=3, pause=0, busy=None, log=None) -> None:
+    self.remux = remux   # remux the .ts file to mp4 with ffmpeg
+    self.archive_root = pathlib.Path(archive_root) if archive_root != '' else None   # move the file to archive_root/username
+    self.save_jobs = save_jobs   # called with the unfinished jobs whenever they change
+    self.nice = nice
+    self.ionice = ionice   # ionice class on linux. 2 : best-effort, 3 : idle
+    self.pause = pause   # jobs wait while this many or more recordings are running. 0 : no wait
+    self.busy = busy or (lambda: 0)   # number of running recordings
+    self.log = log or (lambda message, error=False: None)
+    self.jobs = []   # {'file', 'streamer'} queued and running, in order
+    self.running = dict()   # {file: {'step', 'started', 'size', 'done'}}
+    self.finished = 0
+    self.failed = 0
+    self.procs = set()
+    self.closed = False   # set by close(). no new job or ffmpeg starts after it
+    self.lock = threading.Lock()
+    self.save_lock = threading.Lock()
+    self.queue = queue.Queue()
+    for num in range(workers):
+      threading.Thread(target=self.worker_loop, name='post_{}'.format(num), daemon=True).start()
+
+  def submit(self, file, streamer) -> None:
+    job = self.save(file, streamer)
+    if job is not None:
+      self.queue.put(job)
+
+  # the job is saved without running. it runs at the next start
+  def save(self, file, streamer) -> dict:
+    job = {'file': str(file), 'streamer': streamer}
+    with self.lock:
+      if any(queued['file'] == job['file'] for queued in self.jobs):
+        return None
+      self.jobs.append(job)
+    self.persist()
+    return job
+
+  def persist(self) -> None:
+    with self.save_lock:
+      with self.lock:
+        jobs = list(self.jobs)
+      try:
+        self.save_jobs(jobs)
+      except (OSError, sqlite3.Error) as oe:   # saved again with the next change
+        self.log(f' post-processing queue not saved. {type(oe).__name__}: {oe}', True)
+
+  def worker_loop(self) -> None:
+    self.lower_priority()
+    while True:
+      job = self.queue.get()
+      while self.closed is False and self.pause > 0 and self.busy() >= self.pause:
+        time.sleep(5)   # back-pressure : live recordings first
+      if self.closed:
+        continue   # saved for the next start
+      try:
+        done = self.process(job)
+      except OSError as oe:
+        self.log(f' post-processing of {job["file"]} failed. {type(oe).__name__}: {oe}', True)
+        done = False
+      if self.closed and done is False:
+        continue   # ffmpeg was terminated by close(). saved for the next start
+      with self.lock:
+        self.jobs.remove(job)
+        self.running.pop(job['file'], None)
+        if done:
+          self.finished += 1
+        else:
+          self.failed += 1
+      self.persist()
+
+  # True if the job is done. a failed remux keeps the .ts file
+  def process(self, job: dict) -> bool:
+    file = pathlib.Path(job['file'])
+    remuxed = file.with_suffix('.mp4')
+    started = time.time()
+    if file.is_file() and file.stat().st_size == 0:
+      return True   # nothing was recorded
+    if self.remux and file.is_file():
+      with self.lock:
+        self.running[job['file']] = {'step': 'remux', 'started': started, 'size': file.stat().st_size, 'done': 0}
+      if self.run_ffmpeg(job, file, remuxed) is False:
+        return False
+      file.unlink()
+      file = remuxed
+    elif self.remux and remuxed.is_file():
+      file = remuxed   # remuxed before the restart
+    if file.is_file() is False:
+      return True   # moved before the restart
+    if self.archive_root is not None:
+      target = self.archive_root.joinpath(job['streamer'], file.name)
+      target.parent.mkdir(parents=True, exist_ok=True)
+      with self.lock:
+        self.running[job['file']] = {'step': 'move', 'started': time.time(), 'size': file.stat().st_size, 'done': 0}
+      shutil.move(str(file), str(target))
+      file = target
+    self.log(' post-processing done in {:.0f} seconds. {}'.format(time.time() - started, file))
+    return True
+
+  def run_ffmpeg(self, job: dict, source: pathlib.Path, target: pathlib.Path) -> bool:
+    part = target.with_name(target.name + '.part')
+    args = ['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1', '-y', '-i', str(source), '-c', 'copy', '-bsf:a', 'aac_adtstoasc', '-f', 'mp4', str(part)]
+    if sys.platform.startswith('linux') is False and sys.platform != 'win32' and shutil.which('nice') is not None:
+      args = ['nice', '-n', str(self.nice)] + args
+    creationflags = 0
+    if sys.platform == 'win32' and self.nice > 0:
+      creationflags = subprocess.IDLE_PRIORITY_CLASS if self.nice >= 19 else subprocess.BELOW_NORMAL_PRIORITY_CLASS
+    with self.lock:
+      if self.closed:
+        return False
+      proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, creationflags=creationflags)
+      self.procs.add(proc)
+    errors = []
+    for line in proc.stdout:
+      key, separator, value = line.strip().partition('=')
+      if key == 'total_size' and value.isdigit():
+        self.running[job['file']]['done'] = int(value)
+      elif separator == '' and line.strip() != '':
+        errors.append(line.strip())
+    proc.wait()
+    with self.lock:
+      self.procs.discard(proc)
+    if proc.returncode != 0:
+      part.unlink(missing_ok=True)
+      self.log(' remux of {} failed. ffmpeg exit code: {}. {}'.format(source, proc.returncode, ' '.join(errors[-3:])), True)
+      return False
+    part.replace(target)
+    return True
+
+  # nice and ionice are set per thread on linux. ffmpeg inherits them from the worker thread
+  def lower_priority(self) -> None:
+    if sys.platform.startswith('linux') is False:
+      return
+    tid = threading.get_native_id()
+    try:
+      os.setpriority(os.PRIO_PROCESS, tid, max(self.nice, os.getpriority(os.PRIO_PROCESS, tid)))
+    except OSError:
+      pass
+    if shutil.which('ionice') is not None:
+      subprocess.run(['ionice', '-c', str(self.ionice), '-p', str(tid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+  def status(self) -> dict:
+    now = time.time()
+    with self.lock:
+      running = [{'file': file, 'step': job['step'], 'seconds': round(now - job['started']), 'progress': round(job['done'] / job['size'], 3) if job['size'] > 0 else None}
+                 for file, job in self.running.items()]
+      return {'queued': len(self.jobs) - len(running), 'running': running, 'finished': self.finished, 'failed': self.failed}
+
+  # an unfinished job stays saved and runs again at the next start
+  def close(self) -> None:
+    with self.lock:
+      self.closed = True
+      procs = list(self.procs)
+    for proc in procs:
+      proc.terminate()
+
+
+# one recording of HLSRecorder. it has the same poll(), wait() and terminate() as subprocess.Popen
+class HLSRecording:
+  def __init__(self, recorder: HLSRecorder, url, file_path, resolve=None) -> None:
+    self.recorder = recorder
+    self.url = url
+    self.resolve = resolve   # returns a new variant playlist url when the old one has expired
+    self.file = open(file_path, 'ab')
+    self.returncode = None
+    self.sequence = None   # last sequence sent to download
+    self.pending = collections.deque()   # (sequence, future) in playlist order
+    self.endlist = False
+    self.failures = 0
+    self.bytes_written = 0
+    self.lock = threading.Lock()
+    self.done = threading.Event()
+
+  def poll(self):
+    return self.returncode
+
+  def wait(self, timeout=None):
+    self.done.wait(timeout)
+    return self.returncode
+
+  def terminate(self) -> None:
+    self.finish(-15)
+
+  def kill(self) -> None:
+    self.finish(-9)
+
+  def finish(self, returncode) -> None:
+    with self.lock:
+      if self.returncode is None:
+        self.returncode = returncode
+        for _, future in self.pending:
+          future.cancel()
+        self.pending.clear()
+        self.file.close()
+        self.done.set()
+
+  def reload(self) -> None:
+    if self.returncode is not None:
+      return
+    try:
+      res = self.recorder.get_session(self.url).get(self.url, timeout= self.recorder.timeout)
+      if res.status_code == requests.codes.forbidden and self.resolve is not None:
+        self.url = self.resolve() or self.url
+      if res.status_code != requests.codes.ok:
+        raise requests.exceptions.HTTPError(res.status_code)
+      playlist = media_playlist_parser(res.text, self.url)
+    except Exception:   # also a playlist that can't be parsed. the pool would swallow it and the recording would never be reloaded again
+      self.failures += 1
+      if self.failures >= self.recorder.attempts:
+        self.finish(0 if self.bytes_written > 0 else 1)   # stream ended
+      else:
+        self.recorder.schedule(self, 1)
+      return
+    self.failures = 0
+    segments = playlist['segments']
+    if self.sequence is None and self.recorder.live_restart is False:
+      segments = segments[-self.recorder.live_edge:]
+    for segment in segments:
+      if self.sequence is not None and segment['sequence'] <= self.sequence:
+        continue
+      self.sequence = segment['sequence']
+      if segment['ad']:
+        continue
+      future = self.recorder.pool.submit(self.recorder.download, segment['url'])
+      with self.lock:
+        if self.returncode is not None:
+          future.cancel()
+          return
+        self.pending.append((segment['sequence'], future))
+      future.add_done_callback(self.write)
+    self.endlist = playlist['endlist']
+    self.write()
+    if self.endlist is False:
+      self.recorder.schedule(self, playlist['target_duration'])
+
+  # write the downloaded segments in order
+  def write(self, future=None) -> None:
+    with self.lock:
+      while self.pending != collections.deque() and self.pending[0][1].done():
+        future = self.pending.popleft()[1]
+        if future.cancelled() or future.result() is None:
+          continue
+        self.file.write(future.result())
+        self.bytes_written += len(future.result())
+      if self.returncode is None:
+        self.file.flush()
+      ended = self.endlist and self.pending == collections.deque() and self.returncode is None
+    if ended:
+      self.finish(0)
+
+
+# counters, gauges and histograms in prometheus text format
+class Metrics:
+  buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+  def __init__(self) -> None:
+    self.types = dict()   # {name: (type, help)}
+    self.values = dict()   # {name: {labels: value}}
+    self.histograms = dict()   # {name: {labels: [bucket counts..., sum, count]}}
+    self.lock = threading.Lock()
+
+  def describe(self, name, metric_type, help) -> None:
+    self.types[name] = (metric_type, help)
+
+  def inc(self, name, value=1, **labels) -> None:
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      metric = self.values.setdefault(name, dict())
+      metric[key] = metric.get(key, 0) + value
+
+  def set(self, name, value, **labels) -> None:
+    with self.lock:
+      self.values.setdefault(name, dict())[tuple(sorted(labels.items()))] = value
+
+  def observe(self, name, value, **labels) -> None:
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      histogram = self.histograms.setdefault(name, dict()).setdefault(key, [0] * (len(self.buckets) + 2))
+      for num, bucket in enumerate(self.buckets):
+        if value <= bucket:
+          histogram[num] += 1
+      histogram[-2] += value
+      histogram[-1] += 1
+
+  def render(self) -> str:
+    lines = []
+    with self.lock:
+      for name in self.types:
+        lines.append('# HELP {} {}'.format(name, self.types[name][1]))
+        lines.append('# TYPE {} {}'.format(name, self.types[name][0]))
+        for key, value in self.values.get(name, dict()).items():
+          lines.append('{}{} {}'.format(name, self.format_labels(key), value))
+        for key, histogram in self.histograms.get(name, dict()).items():
+          for num, bucket in enumerate(self.buckets):
+            lines.append('{}_bucket{} {}'.format(name, self.format_labels(key + (('le', bucket),)), histogram[num]))
+          lines.append('{}_bucket{} {}'.format(name, self.format_labels(key + (('le', '+Inf'),)), histogram[-1]))
+          lines.append('{}_sum{} {}'.format(name, self.format_labels(key), histogram[-2]))
+          lines.append('{}_count{} {}'.format(name, self.format_labels(key), histogram[-1]))
+    return '\n'.join(lines) + '\n'
+
+  def format_labels(self, key: tuple) -> str:
+    if key == ():
+      return ''
+    return '{' + ','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in key) + '}'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+  def do_GET(self) -> None:
+    if self.path.split('?')[0] != '/metrics':
+      self.send_error(404)
+      return
+    body = self.server.metrics.render().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args) -> None:
+    pass
+
+
+# local control api. changes are queued and applied by the check loop
+#   GET /streamers : state of every streamer
+#   POST /streamers {"username": "name", "quality": "720p60"} : add a streamer or change its quality
+#   DELETE /streamers/name : stop checking the streamer. its recording keeps running
+#   GET /sessions?username=name : recording history of the state journal
+#   GET /postprocess : queue and progress of the remux and move of finished recordings
+class ControlHandler(BaseHTTPRequestHandler):
+  def do_GET(self) -> None:
+    url = urlsplit(self.path)
+    if url.path.rstrip('/') == '/postprocess' and self.server.check.post_processor is not None:
+      self.send_json(200, {'data': self.server.check.post_processor.status()})
+      return
+    if url.path.rstrip('/') == '/sessions' and self.server.check.journal is not None:
+      query = dict(parameter.split('=', 1) for parameter in url.query.split('&') if '=' in parameter)
+      self.send_json(200, {'data': self.server.check.journal.history(query.get('username'), int(query.get('limit', 100)) if query.get('limit', '').isdigit() else 100)})
+      return
+    if url.path.rstrip('/') != '/streamers':
+      self.send_json(404, {'message': 'not found'})
+      return
+    self.send_json(200, {'data': self.server.check.control_state()})
+
+  def do_POST(self) -> None:
+    if self.path.split('?')[0].rstrip('/') != '/streamers':
+      self.send_json(404, {'message': 'not found'})
+      return
+    try:
+      body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+      id = str(body['username']).strip().lower()
+      quality = str(body.get('quality', self.server.check.quality))
+    except (ValueError, KeyError, TypeError, AttributeError):
+      self.send_json(400, {'message': 'need json {"username": "name", "quality": "quality"}'})
+      return
+    if re.fullmatch(r'[a-z0-9_]{1,25}', id) is None:
+      self.send_json(400, {'message': 'invalid username'})
+      return
+    self.server.check.controls.put(('add', id, quality))
+    self.send_json(202, {'message': 'queued', 'username': id, 'quality': quality})
+
+  def do_DELETE(self) -> None:
+    path = self.path.split('?')[0].rstrip('/').split('/')
+    if len(path) != 3 or path[1] != 'streamers':
+      self.send_json(404, {'message': 'not found'})
+      return
+    id = path[2].lower()
+    if self.server.check.watching(id) is False:
+      self.send_json(404, {'message': 'unknown username'})
+      return
+    self.server.check.controls.put(('remove', id, None))
+    self.send_json(202, {'message': 'queued', 'username': id})
+
+  def send_json(self, status, body: dict) -> None:
+    body = json.dumps(body).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args) -> None:
+    pass
+
+
+# leases of watch list shards in a sqlite file shared by several instances. a shard is checked and recorded by the instance holding its lease
+class ShardLeases:
+  def __init__(self, path, owner, shard_count=16, lease_time=30) -> None:
+    self.owner = owner
+    self.shard_count = shard_count
+    self.lease_time = lease_time   # (seconds) a lease not renewed for this long can be taken by another instance
+    self.renewed = 0   # time of the last renewal
+    self.db = sqlite3.connect(str(path), timeout=lease_time / 3, isolation_level=None, check_same_thread=False)
+    self.db.execute('CREATE TABLE IF NOT EXISTS leases (shard INTEGER PRIMARY KEY, owner TEXT, expires REAL)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS instances (owner TEXT PRIMARY KEY, seen REAL)')
+    self.db.executemany('INSERT OR IGNORE INTO leases VALUES (?, NULL, 0)', ((shard,) for shard in range(shard_count)))
+
+  def shard_of(self, id) -> int:
+    return zlib.crc32(id.encode('utf-8')) % self.shard_count
+
+  # renew the leases, then claim free shards or release shards above the fair share. busy shards (recording) are never released
+  def update(self, busy: set) -> frozenset:
+    now = time.time()
+    self.db.execute('BEGIN IMMEDIATE')
+    try:
+      self.db.execute('INSERT OR REPLACE INTO instances VALUES (?, ?)', (self.owner, now))
+      self.db.execute('DELETE FROM instances WHERE seen < ?', (now - self.lease_time,))
+      instances = self.db.execute('SELECT COUNT(*) FROM instances').fetchone()[0]
+      fair_share = math.ceil(self.shard_count / instances)
+      self.db.execute('UPDATE leases SET expires = ? WHERE owner = ?', (now + self.lease_time, self.owner))
+      owned = [row[0] for row in self.db.execute('SELECT shard FROM leases WHERE owner = ? ORDER BY shard', (self.owner,))]
+      if len(owned) > fair_share:
+        for shard in [shard for shard in owned if shard not in busy][fair_share - len(owned):]:
+          self.db.execute('UPDATE leases SET owner = NULL, expires = 0 WHERE shard = ? AND owner = ?', (shard, self.owner))
+          owned.remove(shard)
+      elif len(owned) < fair_share:
+        for row in self.db.execute('SELECT shard FROM leases WHERE owner IS NULL OR expires < ? ORDER BY shard LIMIT ?', (now, fair_share - len(owned))).fetchall():
+          self.db.execute('UPDATE leases SET owner = ?, expires = ? WHERE shard = ?', (self.owner, now + self.lease_time, row[0]))
+          owned.append(row[0])
+      self.db.execute('COMMIT')
+    except sqlite3.Error:
+      self.db.execute('ROLLBACK')
+      raise
+    self.renewed = now
+    return frozenset(owned)
+
+  def release(self) -> None:
+    self.db.execute('UPDATE leases SET owner = NULL, expires = 0 WHERE owner = ?', (self.owner,))
+    self.db.execute('DELETE FROM instances WHERE owner = ?', (self.owner,))
+
+
+# tokens, recordings and session history in a sqlite WAL file. it survives a crash of TwitchLiveCheck
+class StateJournal:
+  def __init__(self, path) -> None:
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(str(path), timeout=10, isolation_level=None, check_same_thread=False)
+    self.db.row_factory = sqlite3.Row
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    self.db.execute('CREATE TABLE IF NOT EXISTS tokens (name TEXT PRIMARY KEY, value TEXT, expires REAL)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS recordings (id INTEGER PRIMARY KEY AUTOINCREMENT, streamer TEXT, file TEXT, quality TEXT, title TEXT, game TEXT, pid INTEGER, started REAL, ended REAL, exit_code INTEGER)')
+    self.db.execute('CREATE INDEX IF NOT EXISTS recordings_active ON recordings (ended)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS post_jobs (file TEXT PRIMARY KEY, streamer TEXT)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS live_history (streamer TEXT PRIMARY KEY, first_seen REAL, lives TEXT)')
+
+  def get_token(self, name) -> sqlite3.Row:
+    with self.lock:
+      return self.db.execute('SELECT value, expires FROM tokens WHERE name = ?', (name,)).fetchone()
+
+  def set_token(self, name, value, expires=None) -> None:
+    with self.lock:
+      self.db.execute('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)', (name, value, expires))
+
+  def delete_token(self, name) -> None:
+    with self.lock:
+      self.db.execute('DELETE FROM tokens WHERE name = ?', (name,))
+
+  # playback access tokens. {id: {'token', 'expire'}}
+  def load_pats(self) -> dict:
+    with self.lock:
+      rows = self.db.execute("SELECT name, value, expires FROM tokens WHERE name LIKE 'pat:%'").fetchall()
+    return {row['name'][4:]: {'token': json.loads(row['value']), 'expire': row['expires']} for row in rows}
+
+  # (sql, rows) pairs in one transaction. rolled back on error, so a 'database is locked' of another instance doesn't leave the connection in the transaction
+  def write(self, statements: list) -> None:
+    with self.lock:
+      self.db.execute('BEGIN')
+      try:
+        for sql, rows in statements:
+          self.db.executemany(sql, rows)
+        self.db.execute('COMMIT')
+      except Exception:
+        if self.db.in_transaction:
+          self.db.execute('ROLLBACK')
+        raise
+
+  # the PATs of other instances are kept until they expire
+  def save_pats(self, pats: dict) -> None:
+    self.write([("DELETE FROM tokens WHERE name LIKE 'pat:%' AND expires < ?", [(time.time(),)]),
+                ('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)', [('pat:' + id, json.dumps(pats[id]['token']), pats[id]['expire']) for id in pats])])
+
+  # unfinished jobs of PostProcessor
+  def load_post_jobs(self) -> list:
+    with self.lock:
+      return [dict(row) for row in self.db.execute('SELECT file, streamer FROM post_jobs ORDER BY rowid').fetchall()]
+
+  # done : files of the jobs finished since the last save. the jobs of other instances are kept
+  def save_post_jobs(self, jobs: list, done: set) -> None:
+    self.write([('DELETE FROM post_jobs WHERE file = ?', [(file,) for file in done]),
+                ('INSERT OR IGNORE INTO post_jobs VALUES (?, ?)', [(job['file'], job['streamer']) for job in jobs])])
+
+  # go-live times for the poll tiers. {id: {'first_seen', 'lives'}}
+  def load_live_history(self) -> dict:
+    with self.lock:
+      rows = self.db.execute('SELECT streamer, first_seen, lives FROM live_history').fetchall()
+    return {row['streamer']: {'first_seen': row['first_seen'], 'lives': json.loads(row['lives'])} for row in rows}
+
+  def save_live_history(self, history: dict) -> None:
+    self.write([('INSERT OR REPLACE INTO live_history VALUES (?, ?, ?)', [(id, history[id]['first_seen'], json.dumps(history[id]['lives'])) for id in history])])
+
+  def start(self, streamer, file, quality, stream_info: dict, pid) -> int:
+    with self.lock:
+      return self.db.execute('INSERT INTO recordings (streamer, file, quality, title, game, pid, started) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (streamer, str(file), quality, stream_info['title'], stream_info['game'], pid, time.time())).lastrowid
+
+  # exit_code None : the recorder was lost with a crash
+  def finish(self, recording_id, exit_code) -> None:
+    with self.lock:
+      self.db.execute('UPDATE recordings SET ended = ?, exit_code = ? WHERE id = ? AND ended IS NULL', (time.time(), exit_code, recording_id))
+
+  def active(self) -> list:
+    with self.lock:
+      return self.db.execute('SELECT * FROM recordings WHERE ended IS NULL ORDER BY id').fetchall()
+
+  def history(self, streamer=None, limit=100) -> list:
+    with self.lock:
+      if streamer is None:
+        rows = self.db.execute('SELECT * FROM recordings ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+      else:
+        rows = self.db.execute('SELECT * FROM recordings WHERE streamer = ? ORDER BY id DESC LIMIT ?', (streamer, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+
+# recorder left running by a crashed TwitchLiveCheck. found with /proc, so linux only. the exit code is unknown(0)
+class ReattachedProcess:
+  def __init__(self, pid) -> None:
+    self.pid = pid
+    self.returncode = None
+
+  # the process must still have the recording file open, against reused pids
+  @classmethod
+  def find(cls, pid, file) -> 'ReattachedProcess':
+    fd_dir = pathlib.Path('/proc/{}/fd'.format(pid))
+    if pid is None or fd_dir.is_dir() is False:
+      return None
+    file = pathlib.Path(file).resolve()   # the links in /proc are absolute paths
+    try:
+      for fd in fd_dir.iterdir():
+        if fd.readlink() == file:
+          return cls(pid)
+    except OSError:
+      pass
+    return None
+
+  def poll(self):
+    if self.returncode is None and pathlib.Path('/proc/{}'.format(self.pid)).is_dir() is False:
+      self.returncode = 0
+    return self.returncode
+
+  def wait(self, timeout=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while self.poll() is None and (deadline is None or time.monotonic() < deadline):
+      time.sleep(1)
+    return self.returncode
+
+  def terminate(self) -> None:
+    self.send_signal(signal.SIGTERM)
+
+  def kill(self) -> None:
+    self.send_signal(signal.SIGKILL)
+
+  def send_signal(self, sig) -> None:
+    try:
+      kill(self.pid, sig)
+    except OSError:
+      pass
+
+
+# state of one streamer. TwitchLiveCheck keeps one record per streamer and the sets offline, probing and recording as indexes of it
+class StreamerState:
+  __slots__ = ('id', 'quality', 'watched', 'check_num', 'download_path', 'available_quality', 'pat', 'playlist', 'proc', 'record_info', 'batch', 'param',
+               'detect_time', 'push_info', 'upgrade', 'fast_restarts', 'resume', 'lives', 'first_seen', 'user_id')
+
+  def __init__(self, id, quality, download_path: pathlib.Path) -> None:
+    self.id = id
+    self.quality = quality   # recording quality. changed to 'best' after self.check_max
+    self.watched = True   # False after the control api removed it. the record is kept until its recording ends
+    self.check_num = 0
+    self.download_path = download_path
+    self.available_quality = None   # quality found by check_quality(), until the recording starts
+    self.pat = None   # {'token', 'expire'} playback access token
+    self.playlist = None   # {'variants', 'expire'} parsed master playlist, kept for the lifetime of its PAT
+    self.proc = None   # running recorder
+    self.record_info = None   # {'detected', 'started', 'file', 'size', 'stream_info', 'journal_id'} of the running recording
+    self.batch = None   # number of the helix batch. None : not checked with helix
+    self.param = 'user_login=' + id   # part of the helix query, joined once per batch change
+    self.detect_time = None   # time when the live stream was found, for detection to first byte
+    self.push_info = None   # stream info of stream.online. None until probe(). in TwitchLiveCheck.pushed while waiting for quality check
+    self.upgrade = None   # {'quality', 'due', 'future', 'etag', 'digest'} while the recording waits for the recording quality
+    self.fast_restarts = 0   # restarts after an abnormal exit of the recorder
+    self.resume = False   # True : the recording of this stream ended abnormally or was lost with a crash. checked for liveness and not counted as a go-live
+    self.lives = []   # go-live times for the poll tiers. kept across restarts
+    self.first_seen = time.time()   # start of the observed time of the poll tiers. kept across restarts
+    self.user_id = None   # broadcaster id for EventSub and channel info
 
 
 class TwitchLiveCheck:
   # set the default values
   def __init__(self) -> None:
-    self.streamerID = ''   # You can enter up to 100 streamers(api maximum limit), separated by spaces. example: "username1 username2 ... "
+    self.streamerID = ''   # You can enter streamers separated by spaces. they are checked in batches of 100(api maximum limit). example: "username1 username2 ... "
     self.quality_by_streamer = {}   # You can enter the streamer-specific quality if necessary. Don't overlap self.streamerID. example: {"username 1":"quality 1", "username 2":"quality 2"}
     self.quality = 'best'   # Set recording quality.
     self.refresh = 1.5   # Check interval (in seconds) to check for streams. you can enter decimals
     self.check_max = 20   # Set the number of times to check the recording quality. If there's no recording quality beyond the number of searches, change the quality to best. you must enter an integer
     self.root_path = r''   # Set recording path. do not delete thr 'r' character
     self.traceback_log = False   # if True, save traceback log file
+    self.json_log = False   # if True, write the log file as json lines
+    self.summary_interval = 60   # (seconds) the console shows state changes and a summary at this interval. 0 : show the offline streamers after every check
     self.quality_in_title = False   # if True, add quality info to title
     self.custom_options = ''   # cli options for streamlink, separated by spaces. example: 'option1 value1 option2 value2 ... '
     self.legacy_func = False   # if True, use legacy quality check functions
     self.config_path = r''   # set config file path. do not delete thr 'r' character
+    self.pool_size = 10   # number of keep-alive connections kept for each twitch host
+    self.http_retries = 2   # number of retries for connection errors and 5xx responses
+    self.async_engine = False   # if True, run helix polling, quality probing and process checking as concurrent asyncio tasks
+    self.probe_workers = 8   # number of quality checks running at the same time
+    self.cache_path = r''   # set the directory for cache files. if empty, use self.root_path. do not delete the 'r' character
+    self.max_recordings = 0   # maximum number of recordings at the same time. 0 : no limit
+    self.metrics_port = 0   # if not 0, serve prometheus metrics on http://127.0.0.1:metrics_port/metrics
+    self.token_cache = True   # if True, keep the app access token in app_token.json of self.cache_path and reuse it after restart and in other instances. it is not revoked at exit
+    self.state_journal = False   # if True, keep tokens, running recordings and the recording history in state.db of self.cache_path. after a crash, recordings are reattached or started again right away
+    self.control_port = 0   # if not 0, add and remove streamers or change their quality on http://127.0.0.1:control_port/streamers without restart
+    self.recorder = 'streamlink'   # 'streamlink' : record with streamlink processes, 'native' : record in this process with one shared thread pool
+    self.recorder_pool = 0   # number of streamlink recorders started in advance with streamlink imported. need the streamlink python package. 0 : start streamlink when the stream goes live
+    self.direct_hls = False   # if True, pass the variant playlist found by the quality check to streamlink as hls:// url. twitch options of streamlink(--twitch-disable-ads, ...) don't apply to it
+    self.shard_store = r''   # set the path of a sqlite file shared by several TwitchLiveCheck instances with the same streamers. each streamer is checked and recorded by one instance. if empty, check every streamer. do not delete the 'r' character
+    self.eventsub = False   # if True, detect streams with EventSub WebSocket(stream.online) and check them with helix less often. need websocket-client
+    self.eventsub_token = ''   # user access token for EventSub WebSocket. it must be created with self.client_id
+    self.upgrade_quality = False   # if True, record the best available quality right away when the recording quality is not found, and switch to a new file when it appears. not with self.legacy_func
+    self.remux = False   # if True, remux finished recordings to mp4 with ffmpeg. the .ts file is deleted when it succeeds. need ffmpeg
+    self.archive_path = r''   # move finished recordings to archive_path/username. if empty, keep them in self.root_path. do not delete the 'r' character
+    self.post_workers = 1   # number of finished recordings remuxed or moved at the same time
+    self.post_nice = 10   # nice level of the remux and move. on windows, below normal priority(idle with 19)
+    self.post_pause = 0   # remux and move wait while this many or more recordings are running. 0 : no wait
 
     self.oauth = ''   # your OAuth token.
     self.client_id = ''   # Client ID
@@ -31,10 +906,37 @@ class TwitchLiveCheck:
 
 #---Do not edit-------------------------------------------------------------------------------------------------------------------
     self.logger = logging.getLogger(name='TwitchLiveCheck')
+    self.console = logging.getLogger(name='terminal')
     self.timeout = 3.5
+    self.helix_batch_size = 100   # api maximum limit of user_login per request
+    self.helix_workers = 8   # number of helix batches requested at the same time
+    self.proxy_hosts = ('gql.twitch.tv', 'usher.ttvnw.net')   # hosts that use the '--http-proxy' of custom_options
+    self.host_limits = {'gql.twitch.tv': 4, 'usher.ttvnw.net': 6}   # number of requests sent to the host at the same time
+    self.oauth_url = 'https://id.twitch.tv/oauth2'
+    self.helix_url = 'https://api.twitch.tv/helix'
+    self.gql_url = 'https://gql.twitch.tv/gql'
+    self.usher_url = 'https://usher.ttvnw.net/api/channel/hls/{}.m3u8'
+    self.eventsub_url = 'wss://eventsub.wss.twitch.tv/ws'   # twitch cli mock server: 'ws://127.0.0.1:8080/ws' with self.helix_url = 'http://127.0.0.1:8080'
+    self.eventsub_types = ('stream.online',)   # the subscriptions of a websocket session share a small cost limit. the end of a stream is found by the recorder
+    self.poll_tiers = {'hot': 0.5, 'normal': 1, 'cold': 8, 'push': 40}   # check interval of each tier, multiplied by self.refresh. 'push' : subscribed to EventSub
+    self.hot_window = 30   # (minutes) a streamer is 'hot' around the time of day it went live before
+    self.dormant_days = 7   # a streamer is 'cold' if it hasn't gone live for this many days, counted from when it was first checked. the go-live times are kept in live_history.json of self.cache_path or state.db
+    self.live_history_size = 20   # number of go-live times kept for each streamer
+    self.pat_refresh_interval = 10   # (seconds) interval of the PAT refresh thread
+    self.pat_refresh_margin = 120   # (seconds) renew the PAT this long before it expires
+    self.pat_prefetch_max = 50   # number of PATs renewed at once
+    self.restart_max = 3   # number of restarts right after an abnormal exit of the recorder. reset when a recording lasts a minute
+    self.native_workers = 32   # number of segment downloads running at the same time with self.recorder = 'native'
+    self.upgrade_interval = 3   # (seconds) interval of the master playlist check while waiting for the recording quality
+    self.upgrade_overlap = 10   # (seconds) the replaced recording keeps running this long after the switch, so no footage is lost
+    self.shard_count = 16   # number of watch list shards in self.shard_store. every instance must use the same value
+    self.lease_time = 30   # (seconds) shards of an instance that stopped are taken over after this
+    self.token_validate_interval = 3600   # (seconds) twitch asks apps to validate their token every hour
+    self.token_refresh_margin = 86400   # (seconds) renew the app access token this long before it expires
+    self.post_ionice = 3   # ionice class of the remux and move on linux. 2 : best-effort, 3 : idle
 
   def __repr__(self) -> str:
-    private_information = ['client_id', 'client_secret', 'user_token', 'download_path', 'pat']
+    private_information = ['client_id', 'client_secret', 'user_token', 'streamers', 'eventsub_token']
     variables = vars(self).copy()
     variables.update(dict.fromkeys(private_information, '******'))   # for security
     if 'streamlink_args' in variables.keys():
@@ -45,20 +947,53 @@ class TwitchLiveCheck:
   def run(self) -> None:
     
     #self.print_log(self.logger, 'info', self)
-    self.user_token = self.create_token()
+    self.start_console()
     self.make_vars()
-    atexit.register(self.revoke_token)
+    self.make_path()
+    if self.state_journal:
+      self.open_journal()
+    self.user_token = self.load_token() or self.create_token()
+    threading.Thread(target=self.token_refresh_loop, name='token_refresh', daemon=True).start()
+    atexit.register(self.close_sessions)
+    if self.token_cache is False:
+      atexit.register(self.revoke_token)
+    atexit.register(self.release_shards)
     atexit.register(self.terminate_proc)
 
     self.process_username()
     self.make_streamer_list()
-    self.make_path()
+    self.load_live_history(list(self.streamers))
+    atexit.register(self.save_live_history)
 
     self.make_streamlink_args()
 
-    self.url_params = self.create_params(self.streamerID)
-    print("Checking for", self.streamerID, "every", self.refresh, "seconds. Record with", self.quality, "quality.")
-    self.loop_check()
+    if self.shard_store != '':
+      self.start_shards()
+    self.make_batches()
+    if self.metrics_port != 0:
+      self.start_metrics_server()
+    if self.control_port != 0:
+      self.start_control_server()
+    if self.recorder == 'native':
+      self.hls_recorder = HLSRecorder(self.get_session, self.native_workers, self.timeout, live_edge=6, live_restart=True)
+    elif self.recorder_pool > 0:
+      self.recorder_workers = RecorderPool(self.recorder_worker_command(), self.recorder_pool)
+      atexit.register(self.recorder_workers.close)
+    if self.legacy_func is False:
+      self.load_pat_cache()
+      atexit.register(self.save_pat_cache)
+      threading.Thread(target=self.pat_refresh_loop, name='pat_refresh', daemon=True).start()
+    if self.eventsub:
+      self.start_eventsub()
+    if self.remux or self.archive_path != '':
+      self.start_post_processor()
+    if self.journal is not None:
+      self.resume_recordings()
+    self.echo("Checking for", sorted(self.offline), "every", self.refresh, "seconds. Record with", self.quality, "quality.")
+    if self.async_engine:
+      asyncio.run(self.async_loop_check())
+    else:
+      self.loop_check()
 
   def make_streamlink_args(self):
     # apply custom options to streamlink
@@ -74,17 +1009,179 @@ class TwitchLiveCheck:
         #self.legacy_func = True
         self.streamlink_quality_args.append('--http-proxy')
         self.streamlink_quality_args.append(self.custom_options[self.custom_options.index('--http-proxy') + 1])
-        self.proxies = {'http': self.custom_options[self.custom_options.index('--http-proxy') + 1],
-                        'https': self.custom_options[self.custom_options.index('--http-proxy') + 1]
-                        }
+        self.set_proxies(self.custom_options[self.custom_options.index('--http-proxy') + 1])
       self.streamlink_args.extend(self.custom_options)
 
   def make_vars(self):
-    self.download_path = dict()
-    self.procs = dict()
-    self.pat = dict()
-    self.available_quality = dict()
+    self.streamers = dict()   # {id: StreamerState}
+    self.offline = set()   # streamers checked with helix
+    self.probing = set()   # streamers under quality check. they stay in their helix batch
+    self.recording = set()   # streamers with a running recorder
+    self.pat_lock = threading.Lock()
+    self.pat_changed = False
     self.proxies = None   # if self.custom_options has '--http-proxy', make_streamlink_args() will change this value
+    self.streamlink_session = None   # in-process streamlink for self.legacy_func. created by get_streamlink_session()
+    self.recorder_workers = None   # RecorderPool with self.recorder_pool
+    self.shard_leases = None   # ShardLeases with self.shard_store
+    self.owned_shards = frozenset()   # set by shard_loop()
+    self.applied_shards = frozenset()   # shards whose streamers are in the helix batches
+    self.controls = queue.Queue()   # (command, id, quality) from the control api
+    self.journal = None   # StateJournal with self.state_journal
+    self.token_expire = 0   # expiration time of self.user_token
+    self.token_event = threading.Event()   # set when helix answers unauthorized. token_refresh_loop() renews the token right away
+    self.summary_time = 0   # time of the last summary of print_status()
+    self.sessions = dict()
+    self.session_lock = threading.Lock()
+    self.rate_limiter = RateLimiter()
+    self.history_changed = False   # go-live times or new streamers, saved by save_live_history()
+    self.history_lock = threading.Lock()
+    self.retier_time = time.time()
+    self.batch_lock = threading.RLock()
+    self.exit_events = queue.Queue()   # (id, proc, return code) from watch_recorder()
+    self.retiring = []   # (proc, terminate time, journal id, file) of recordings replaced by upgrade_record(). terminate time is None once terminated
+    self.post_processor = None   # PostProcessor with self.remux or self.archive_path
+    self.post_files = set()   # files of the saved jobs of this instance
+    self.make_metrics()
+    self.push_events = queue.Queue()   # streamers reported by stream.online
+    self.pushed = set()   # streamers waiting for quality check after stream.online
+    self.eventsub_subscribed = set()
+    self.eventsub_connected = False
+    self.eventsub_started = False   # set by start_eventsub()
+    self.eventsub_session_id = None   # id of the connected EventSub session, for the streamers added later
+    self.helix_pool = ThreadPoolExecutor(max_workers=self.helix_workers, thread_name_prefix='helix')
+    self.probe_pool = ThreadPoolExecutor(max_workers=self.probe_workers, thread_name_prefix='probe')
+    self.host_semaphores = {host: threading.BoundedSemaphore(self.host_limits[host]) for host in self.host_limits}
+
+  def make_metrics(self) -> None:
+    self.metrics = Metrics()
+    self.metrics.describe('twitch_helix_request_seconds', 'histogram', 'Latency of helix /streams requests.')
+    self.metrics.describe('twitch_helix_requests_total', 'counter', 'Helix /streams responses by status code.')
+    self.metrics.describe('twitch_helix_ratelimit_remaining', 'gauge', 'Ratelimit-Remaining of the last helix response.')
+    self.metrics.describe('twitch_probe_request_seconds', 'histogram', 'Latency of gql and usher requests of the quality check.')
+    self.metrics.describe('twitch_quality_retries_total', 'counter', 'Failed quality checks (check_num increments).')
+    self.metrics.describe('twitch_detection_to_first_byte_seconds', 'histogram', 'Time from finding the live stream to the first byte of the recording.')
+    self.metrics.describe('twitch_active_recorders', 'gauge', 'Number of running recorders.')
+    self.metrics.describe('twitch_recorder_exits_total', 'counter', 'Recorder exits by exit code.')
+    self.metrics.describe('twitch_recorded_bytes_total', 'counter', 'Bytes written by the recorders of each channel.')
+    self.metrics.describe('twitch_post_queue_depth', 'gauge', 'Finished recordings waiting for or under remux and move.')
+    self.metrics.describe('twitch_post_jobs_total', 'counter', 'Finished post-processing jobs by result.')
+
+  def start_metrics_server(self) -> None:
+    server = ThreadingHTTPServer(('127.0.0.1', self.metrics_port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = self.metrics
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    self.print_log(self.logger, 'info', ' metrics: http://127.0.0.1:{}/metrics'.format(server.server_address[1]))
+
+  def start_control_server(self) -> None:
+    server = ThreadingHTTPServer(('127.0.0.1', self.control_port), ControlHandler)
+    server.daemon_threads = True
+    server.check = self
+    threading.Thread(target=server.serve_forever, name='control', daemon=True).start()
+    self.print_log(self.logger, 'info', ' control: http://127.0.0.1:{}/streamers'.format(server.server_address[1]))
+
+  # apply the commands of the control api in the check loop
+  def apply_controls(self) -> None:
+    retry = []
+    while True:
+      try:
+        command, id, quality = self.controls.get_nowait()
+      except queue.Empty:
+        break
+      if command == 'add':
+        self.add_streamer(id, quality)
+      elif self.remove_streamer(id) is False:
+        retry.append((command, id, quality))
+    for control in retry:
+      self.controls.put(control)
+
+  # new streamer or new quality. the quality of a running recording changes from the next recording
+  def add_streamer(self, id, quality) -> None:
+    state = self.streamers.get(id)
+    if state is None or state.watched is False:
+      if state is None:
+        state = self.new_streamer(id, quality)
+        self.load_live_history([id])
+      state.watched = True
+      self.print_log(self.logger, 'info', ' {} added. quality: {}'.format(id, quality))
+    else:
+      self.print_log(self.logger, 'info', ' {} quality changed: {} -> {}'.format(id, state.quality, quality))
+    state.quality = quality
+    state.check_num = 0
+    if state.proc is None and self.owns(id):
+      self.add_to_batch(id)
+    if self.eventsub_started and state.user_id is None:
+      threading.Thread(target=self.eventsub_add, args=(id,), name='eventsub_add', daemon=True).start()
+
+  # False while the streamer is being checked by the asyncio engine
+  def remove_streamer(self, id) -> bool:
+    if self.watching(id) is False:
+      return True
+    if id in self.probing:
+      return False
+    self.remove_from_batch(id)
+    state = self.streamers[id]
+    state.watched = False
+    if state.proc is None:
+      del self.streamers[id]
+    self.pushed.discard(id)
+    state.detect_time = None
+    self.print_log(self.logger, 'info', ' {} removed.{}'.format(id, ' recording continues.' if state.proc is not None else ''))
+    return True
+
+  def control_state(self) -> list:
+    state = []
+    for id, streamer in sorted(list(self.streamers.items())):
+      record_info = streamer.record_info
+      if streamer.proc is not None:
+        status = 'recording' if streamer.watched else 'recording (removed)'
+      elif id in self.probing:
+        status = 'probing'
+      elif streamer.batch is not None:
+        status = 'checking'
+      else:
+        status = 'other shard'
+      state.append({'username': id, 'quality': streamer.quality if streamer.watched else None, 'status': status, 'check_num': streamer.check_num,
+                    'file': str(record_info['file']) if record_info is not None else None})
+    return state
+
+  # one keep-alive connection pool for each host
+  def get_session(self, url) -> requests.Session:
+    host = urlsplit(url).netloc
+    if host in self.sessions:
+      return self.sessions[host]
+    with self.session_lock:
+      if host in self.sessions:
+        return self.sessions[host]
+      session = requests.Session()
+      retry = Retry(total=self.http_retries, connect=self.http_retries, read=self.http_retries, status=self.http_retries, backoff_factor=0.1,
+                    status_forcelist=[500, 502, 503, 504], allowed_methods=None, raise_on_status=False, respect_retry_after_header=False)
+      adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+      session.mount('https://', adapter)
+      session.mount('http://', adapter)
+      if host in self.proxy_hosts and self.proxies is not None:
+        session.proxies.update(self.proxies)
+      self.sessions[host] = session
+      return session
+
+  # request with the session of the host, within self.host_limits
+  def request(self, method, url, **kwargs) -> requests.Response:
+    host = urlsplit(url).netloc
+    if host not in self.host_semaphores:
+      return self.get_session(url).request(method, url, **kwargs)
+    with self.host_semaphores[host]:
+      return self.get_session(url).request(method, url, **kwargs)
+
+  # apply the proxy to the sessions of self.proxy_hosts
+  def set_proxies(self, proxy) -> None:
+    self.proxies = {'http': proxy, 'https': proxy}
+    for host in self.sessions:
+      if host in self.proxy_hosts:
+        self.sessions[host].proxies.update(self.proxies)
+
+  def close_sessions(self) -> None:
+    for host in list(self.sessions):
+      self.sessions.pop(host).close()
 
   def process_username(self) -> None:
     # change username to lowercase
@@ -96,34 +1193,191 @@ class TwitchLiveCheck:
     del processed_username
     if '' in self.quality_by_streamer:
       self.quality_by_streamer.pop('')
-    self.stream_quality = self.quality_by_streamer
 
+  # make_batches() keeps only the streamers of the shards this instance holds
+  def start_shards(self) -> None:
+    self.shard_leases = ShardLeases(self.shard_store, '{}-{}'.format(socket.gethostname(), getpid()), self.shard_count, self.lease_time)
+    self.owned_shards = self.applied_shards = self.shard_leases.update(set())
+    threading.Thread(target=self.shard_loop, name='shard_leases', daemon=True).start()
+    self.print_log(self.logger, 'info', ' shard store: {}. {} of {} shards'.format(self.shard_store, len(self.owned_shards), self.shard_count))
+
+  # renew the leases 3 times per self.lease_time. if the store can't be reached until the leases expire, check no streamer
+  def shard_loop(self) -> None:
+    while True:
+      time.sleep(self.lease_time / 3)
+      try:
+        self.owned_shards = self.shard_leases.update({self.shard_leases.shard_of(id) for id in list(self.recording)})
+      except sqlite3.Error as se:
+        self.print_log(self.logger, 'error', None, f'shard store. {type(se).__name__}: {se}')
+        if time.time() - self.shard_leases.renewed > self.lease_time * 2 / 3:
+          self.owned_shards = frozenset()
+
+  # start or stop checking the streamers of shards claimed or released by shard_loop(). recordings keep running
+  def apply_shards(self) -> None:
+    owned = self.owned_shards
+    if self.shard_leases is None or owned == self.applied_shards:
+      return
+    self.print_log(self.logger, 'info', ' shards changed. {} of {} shards'.format(len(owned), self.shard_count))
+    self.applied_shards = owned
+    for id, state in self.streamers.items():
+      if state.proc is not None or state.watched is False:
+        continue
+      if self.shard_leases.shard_of(id) in owned:
+        self.add_to_batch(id)
+      elif state.batch is not None:
+        self.remove_from_batch(id)
+        self.pushed.discard(id)
+
+  # the latest leases of shard_loop(), before apply_shards()
+  def owns(self, id) -> bool:
+    return self.shard_leases is None or self.shard_leases.shard_of(id) in self.owned_shards
+
+  # in the watch list of the config file or the control api
+  def watching(self, id) -> bool:
+    state = self.streamers.get(id)
+    return state is not None and state.watched
+
+  # offline or under quality check
+  def checking(self, id) -> bool:
+    state = self.streamers.get(id)
+    return state is not None and state.batch is not None
+
+  def release_shards(self) -> None:
+    if self.shard_leases is not None:
+      self.shard_leases.release()
+
+  # resolved by make_path()
+  def cache_dir(self) -> pathlib.Path:
+    return self.cache_path
+
+  def open_journal(self) -> None:
+    self.journal = StateJournal(self.cache_dir().joinpath('state.db'))
+
+  # cached app access token of the previous run or another instance, if it is still valid
+  def load_token(self) -> str:
+    if self.journal is not None:
+      row = self.journal.get_token('app')
+      cache = {'token': row['value'], 'expires': row['expires'], 'client_id': self.client_id} if row is not None else None
+    elif self.token_cache:
+      try:
+        cache = json.loads(self.cache_dir().joinpath('app_token.json').read_text(encoding='utf-8'))
+      except (OSError, ValueError):
+        cache = None
+    else:
+      cache = None
+    if cache is None or cache.get('client_id') != self.client_id or (cache.get('expires') or 0) - time.time() < self.token_refresh_margin:
+      return None
+    api = self.oauth_url + '/validate'
+    try:
+      res = self.get_session(api).get(api, headers={'Authorization': 'Bearer {}'.format(cache['token'])}, timeout= self.timeout)
+    except requests.exceptions.RequestException:
+      return None
+    if res.status_code != requests.codes.ok:
+      return None
+    self.token_expire = time.time() + res.json().get('expires_in', 0)
+    self.print_log(self.logger, 'info', None, 'reuse the cached app access token')
+    return cache['token']
+
+  def save_token(self, token) -> None:
+    if self.journal is not None:
+      self.journal.set_token('app', token, self.token_expire)
+    elif self.token_cache:
+      cache_file = self.cache_dir().joinpath('app_token.json')
+      temp_file = cache_file.with_suffix('.{}.tmp'.format(getpid()))
+      temp_file.write_text(json.dumps({'token': token, 'expires': self.token_expire, 'client_id': self.client_id}), encoding='utf-8')
+      temp_file.replace(cache_file)
+
+  # validate the app access token every self.token_validate_interval and renew it before it expires, off the check loop
+  def token_refresh_loop(self) -> None:
+    while True:
+      unauthorized = self.token_event.wait(self.token_validate_interval)
+      self.token_event.clear()
+      try:
+        if unauthorized or self.token_expire - time.time() < self.token_refresh_margin:
+          token = self.load_token()   # another instance may have renewed it already
+          if token is None or token == self.user_token:
+            token = self.create_token()
+          if token is not None:
+            self.user_token = token
+        else:
+          self.validate_token()
+      except requests.exceptions.RequestException as rqe:
+        self.print_log(self.logger, 'error', None, f'app access token refresh. {type(rqe).__name__}: {rqe}')
+        time.sleep(self.timeout)
+      except Exception as e:   # keep renewing the token. detection stops without it
+        self.print_log(self.logger, 'error', f'app access token refresh. {type(e).__name__}: {e}', traceback.format_exc())
+        time.sleep(self.timeout)
+
+  # recordings of the previous run : reattach to the recorders still running, check the others right away without waiting for helix
+  def resume_recordings(self) -> None:
+    for row in self.journal.active():
+      id = row['streamer']
+      if self.owns(id) is False:
+        continue   # recorded by the instance holding the shard
+      stream_info = {'title': row['title'] or '', 'game': row['game'] or ''}
+      proc = ReattachedProcess.find(row['pid'], row['file']) if id not in self.recording else None
+      if proc is None:
+        self.journal.finish(row['id'], None)
+        self.post_process(row['file'])   # the recorder died with the crash
+        if self.checking(id):
+          self.streamers[id].resume = True
+          self.push(id, stream_info)
+          self.print_log(self.logger, 'info', ' {} was being recorded. check again...'.format(id), '{} resume recording'.format(id))
+        continue
+      self.remove_from_batch(id)
+      try:
+        size = pathlib.Path(row['file']).stat().st_size
+      except OSError:
+        size = 0
+      state = self.streamers.get(id)
+      if state is None:
+        state = self.new_streamer(id, None)   # removed from the watch list since the crash
+        state.watched = False
+      state.proc = proc
+      self.recording.add(id)
+      state.record_info = {'detected': row['started'], 'started': row['started'], 'file': pathlib.Path(row['file']), 'size': size, 'stream_info': stream_info, 'journal_id': row['id']}
+      self.watch_recorder(id, proc)
+      self.print_log(self.logger, 'info', ' {} recording is still running. reattached. pid: {}'.format(id, row['pid']), '{} reattached. pid: {}'.format(id, row['pid']))
+
+  # the streamer options become StreamerState records. the control api changes the records afterwards
   def make_streamer_list(self) -> None:
-    self.streamerID = list(self.quality_by_streamer.keys())
-    if self.streamerID == []:
+    if self.quality_by_streamer == {}:
       self.print_log(self.logger, 'error', 'Please enter the streamer username', 'no streamer username')
       raise Exception('Please enter the streamer username')
-    self.check_num = dict.fromkeys(self.streamerID, 0)
-  
+    for id in self.quality_by_streamer:
+      self.new_streamer(id, self.quality_by_streamer[id])
+    del self.streamerID, self.quality_by_streamer
+
+  def new_streamer(self, id, quality) -> StreamerState:
+    download_path = self.download_root.joinpath(id)
+    if(download_path.is_dir() is False):
+      download_path.mkdir(parents=True, exist_ok=True)
+    self.streamers[id] = StreamerState(id, quality, download_path)
+    self.history_changed = True
+    return self.streamers[id]
+
+  # before the app access token and the journal, which are kept in self.cache_path
   def make_path(self):
-    for id in self.streamerID:
-      self.download_path[id] = pathlib.Path(self.root_path).joinpath(id)
-      if(pathlib.Path(self.download_path[id]).is_dir() is False):
-        pathlib.Path(self.download_path[id]).mkdir(parents=True, exist_ok=True)
+    self.cache_path = pathlib.Path(self.cache_path or self.root_path or '.')
+    self.cache_path.mkdir(parents=True, exist_ok=True)
+    self.download_root = pathlib.Path(self.root_path)
     del self.root_path
 
   # create app access token
   def create_token(self) -> str:
-    api = 'https://id.twitch.tv/oauth2/token'
+    api = self.oauth_url + '/token'
     payload = {
       'client_id': self.client_id,
       'client_secret': self.client_secret,
       'grant_type': 'client_credentials',
       'scope': ''
     }
-    res = requests.post(api, json=payload, timeout= self.timeout)
+    token = None
+    res = self.get_session(api).post(api, json=payload, timeout= self.timeout)
     if res.status_code == requests.codes.ok:
       token = res.json()['access_token']
+      self.token_expire = time.time() + res.json().get('expires_in', 0)
+      self.save_token(token)
     elif res.status_code == requests.codes.bad_request:
       raise Exception(res.json()['message'])
     elif res.status_code == requests.codes.forbidden:
@@ -134,72 +1388,242 @@ class TwitchLiveCheck:
 
   # check app access token
   def validate_token(self) -> None:
-    api = 'https://id.twitch.tv/oauth2/validate'
+    api = self.oauth_url + '/validate'
     h = {'Authorization': f'Bearer {self.user_token}'}
-    res = requests.get(api, headers=h, timeout= self.timeout)
+    res = self.get_session(api).get(api, headers=h, timeout= self.timeout)
     if res.status_code != requests.codes.ok:
       self.print_log(self.logger, 'info', " invalid access token. regenerate token...", 'regenerate token')
-      self.user_token = self.create_token()
+      self.user_token = self.create_token() or self.user_token
+    else:
+      self.token_expire = time.time() + res.json().get('expires_in', 0)
 
   # revoke app access token
   def revoke_token(self) -> None:
-    api = 'https://id.twitch.tv/oauth2/revoke'
+    api = self.oauth_url + '/revoke'
     payload = {
       'client_id': self.client_id,
       'token': self.user_token
     }
-    res = requests.post(api, json=payload, timeout= self.timeout)
+    res = self.get_session(api).post(api, json=payload, timeout= self.timeout)
+    if self.journal is not None:
+      self.journal.delete_token('app')
     self.print_log(self.logger, 'info', 'app access token revoked')
 
-  # create url params
-  def create_params(self, username) -> str:
-    params = ''
-    for id in username:
-      params = params + f'&user_login={id}'
-    params = params[1:]
-    return params
+  # split the watch list into batches of self.helix_batch_size streamers. each batch holds streamers of one tier
+  def make_batches(self) -> None:
+    self.batches = []   # sets of streamers
+    self.batch_tier = []
+    self.batch_due = []
+    self.url_params = []   # None : the batch has changed. joined again by batch_params() before the next request
+    for id in self.streamers:
+      if self.owns(id):
+        self.add_to_batch(id)
 
-  def check_live(self) -> dict:
+  # put the streamer into the first batch of its tier with room. offline from now on, unless it is under quality check
+  def add_to_batch(self, id) -> None:
+    with self.batch_lock:
+      state = self.streamers[id]
+      if state.batch is not None:
+        return
+      tier = self.streamer_tier(id)
+      for num, batch in enumerate(self.batches):
+        if self.batch_tier[num] == tier and len(batch) < self.helix_batch_size:
+          break
+        elif len(batch) == 0:
+          self.batch_tier[num] = tier
+          self.batch_due[num] = 0
+          break
+      else:
+        self.batches.append(set())
+        self.batch_tier.append(tier)
+        self.batch_due.append(0)
+        self.url_params.append(None)
+        num = len(self.batches) - 1
+      self.batches[num].add(id)
+      self.url_params[num] = None
+      state.batch = num
+      if id not in self.probing:
+        self.offline.add(id)
+
+  # empty batches are kept and reused by add_to_batch()
+  def remove_from_batch(self, id) -> None:
+    with self.batch_lock:
+      state = self.streamers.get(id)
+      if state is None or state.batch is None:
+        return
+      self.batches[state.batch].discard(id)
+      self.url_params[state.batch] = None
+      state.batch = None
+      self.offline.discard(id)
+
+  # query of the batch from the fragments of its streamers
+  def batch_params(self, num) -> str:
+    if self.url_params[num] is None:
+      self.url_params[num] = '&'.join(self.streamers[id].param for id in self.batches[num])
+    return self.url_params[num]
+
+  # 'hot' : went live around this time of day before, 'cold' : no go-live in self.dormant_days of observed time
+  def streamer_tier(self, id) -> str:
+    if self.eventsub_connected and id in self.eventsub_subscribed:
+      return 'push'
+    state = self.streamers[id]
+    history = state.lives
+    now = time.time()
+    if now - (history[-1] if history != [] else state.first_seen) > self.dormant_days * 86400:
+      return 'cold'
+    now_minute = now % 86400 / 60
+    for live_time in history:
+      diff = abs(live_time % 86400 / 60 - now_minute)
+      if min(diff, 1440 - diff) <= self.hot_window:
+        return 'hot'
+    return 'normal'
+
+  def record_live(self, id) -> None:
+    history = self.streamers[id].lives
+    history.append(time.time())
+    del history[:-self.live_history_size]
+    self.history_changed = True
+
+  def read_live_history(self) -> dict:
+    if self.journal is not None:
+      return self.journal.load_live_history()
     try:
-      api = 'https://api.twitch.tv/helix/streams?' + self.url_params
-      h = {'Authorization': f'Bearer {self.user_token}', 'Client-Id': self.client_id}
-      info = dict()
-      if self.streamerID != []:
-        res = requests.get(api, headers=h, timeout= self.timeout)
+      return json.loads(self.cache_path.joinpath('live_history.json').read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+      return {}
+
+  # go-live times of the previous runs. the observed time of a streamer starts at its first check, also before the restart
+  def load_live_history(self, ids) -> None:
+    cache = self.read_live_history()
+    for id in ids:
+      if id in cache:
+        state = self.streamers[id]
+        state.first_seen = min(state.first_seen, cache[id]['first_seen'])
+        state.lives = sorted(set(cache[id]['lives'] + state.lives))[-self.live_history_size:]
+
+  # merged with the saved history. other instances with the same self.cache_path keep their streamers in it too
+  def save_live_history(self) -> None:
+    with self.history_lock:
+      if self.history_changed is False:
+        return
+      self.history_changed = False
+      try:
+        cache = self.read_live_history()
+        history = dict()
+        for id, state in list(self.streamers.items()):
+          saved = cache.get(id, {'first_seen': state.first_seen, 'lives': []})
+          history[id] = {'first_seen': min(state.first_seen, saved['first_seen']), 'lives': sorted(set(saved['lives'] + state.lives))[-self.live_history_size:]}
+        if self.journal is not None:
+          self.journal.save_live_history(history)
+          return
+        cache.update(history)
+        cache_file = self.cache_path.joinpath('live_history.json')
+        temp_file = cache_file.with_suffix('.{}.tmp'.format(getpid()))
+        temp_file.write_text(json.dumps(cache), encoding='utf-8')
+        temp_file.replace(cache_file)
+      except (OSError, sqlite3.Error) as oe:
+        self.history_changed = True   # saved again with the next retier
+        self.print_log(self.logger, 'error', None, f'live history. {type(oe).__name__}: {oe}')
+
+  # move offline streamers whose tier has changed. checked once a minute
+  def retier(self, force=False) -> None:
+    if time.time() - self.retier_time < 60 and force is False:
+      return
+    self.retier_time = time.time()
+    with self.batch_lock:
+      for num, batch in enumerate(self.batches):
+        for id in list(batch):
+          if self.batch_tier[num] != self.streamer_tier(id):
+            # the streamer stays in self.offline. the eventsub thread calls this too
+            batch.discard(id)
+            self.url_params[num] = None
+            self.streamers[id].batch = None
+            self.add_to_batch(id)
+    self.save_live_history()
 
-        # unauthorized : token expired
-        if res.status_code == requests.codes.unauthorized:
-          self.user_token = self.create_token()
+  # shortest check interval, used as the loop interval
+  def tick(self) -> float:
+    return self.refresh * min(self.poll_tiers.values())
+
+  # stretch every interval when the batches need more requests than the rate limit allows
+  def interval_scale(self) -> float:
+    demand = sum(1 / (self.refresh * self.poll_tiers[self.batch_tier[num]]) for num, batch in enumerate(self.batches) if len(batch) > 0)
+    return max(1, demand / self.rate_limiter.rate())
+
+  def request_streams(self, params) -> requests.Response:
+    api = self.helix_url + '/streams?' + params
+    h = {'Authorization': f'Bearer {self.user_token}', 'Client-Id': self.client_id}
+    start = time.monotonic()
+    res = self.get_session(api).get(api, headers=h, timeout= self.timeout)
+    self.metrics.observe('twitch_helix_request_seconds', time.monotonic() - start)
+    self.metrics.inc('twitch_helix_requests_total', code=res.status_code)
+    return res
+
+  # request every due batch at the same time, within the rate limit, and merge the live streams
+  def fetch_streams(self) -> list:
+    self.retier()
+    now = time.time()
+    scale = self.interval_scale()
+    futures = []
+    with self.batch_lock:
+      for num in sorted((num for num, batch in enumerate(self.batches) if len(batch) > 0 and self.batch_due[num] <= now), key=lambda num: self.batch_due[num]):
+        if self.rate_limiter.acquire() is False:
+          break
+        self.batch_due[num] = now + self.refresh * self.poll_tiers[self.batch_tier[num]] * scale
+        futures.append((num, self.helix_pool.submit(self.request_streams, self.batch_params(num))))
+    data = []
+    token_expired = False
+    for num, future in futures:
+      try:
+        res = future.result()
+      except requests.exceptions.ConnectionError as ce:
+        self.print_log(self.logger, 'error', " requests.exceptions.ConnectionError. Go back checking...", f'{type(ce).__name__}: {ce}')
+        continue
+      except requests.exceptions.ReadTimeout as rt:
+        self.print_log(self.logger, 'error', " requests.exceptions.ReadTimeout. Go back checking...", f'{type(rt).__name__}: {rt}')
+        continue
+
+      self.rate_limiter.update(res.headers)
+      if 'Ratelimit-Remaining' in res.headers:
+        self.metrics.set('twitch_helix_ratelimit_remaining', int(res.headers['Ratelimit-Remaining']))
+      # unauthorized : token expired. token_refresh_loop() renews it and the batch is checked again on the next tick
+      if res.status_code == requests.codes.unauthorized:
+        self.batch_due[num] = 0
+        if token_expired is False:
+          token_expired = True
           res_message = res.json()['message']
           self.print_log(self.logger, 'error', f" {res_message}. regenerate token...", f"{res_message}. regenerate token...")
-        
-        # bad_request : invalid client id or client secret
-        elif res.status_code == requests.codes.bad_request:
-          raise Exception(res.json()['message'])
-        
-        # too_many_requests : api rate limit exceeded wait until reset time
-        elif res.status_code == requests.codes.too_many_requests:
-          self.print_log(self.logger, 'error', ' Too many request! wait until reset-time...', 'Too many request!')
-          reset_time = int(res.headers['Ratelimit-Reset'])
-          while(True):
-            now_timestamp = time.time()
-            if reset_time < now_timestamp:
-              self.print_log(self.logger, 'info', ' Reset-time! continue to check...', 'Reset-time! continue to check...')
-              break
-            else:
-              self.check_process()
-              print(' Check streamlink process...', 'reset-time:', reset_time, ', now:', now_timestamp)
-              time.sleep(self.refresh)
-        elif res.status_code != requests.codes.ok:
-          self.print_log(self.logger, 'error', ' server error(live)! status_code: {}'.format(res.status_code), 'server error(live)! status_code: {0} \n message: {1}'.format(res.status_code, res.text))
-        elif res.json()['data'] == []:
-          pass
-        else:
-          for i in res.json()['data']:
-            if self.check_quality(i['user_login']):
-              info[i['user_login']] = {'title': i['title'], 'game': i['game_name']}
-              self.streamerID.remove(i['user_login'])
-          self.url_params = self.create_params(self.streamerID)
+          self.token_event.set()
+
+      # bad_request : invalid client id or client secret
+      elif res.status_code == requests.codes.bad_request:
+        raise Exception(res.json()['message'])
+
+      # too_many_requests : api rate limit exceeded. the batch is checked again after reset time
+      elif res.status_code == requests.codes.too_many_requests:
+        self.rate_limiter.block(int(res.headers['Ratelimit-Reset']))
+        self.print_log(self.logger, 'error', ' Too many request! slow down until reset-time...', 'Too many request! reset-time: {}'.format(res.headers['Ratelimit-Reset']))
+      elif res.status_code != requests.codes.ok:
+        self.print_log(self.logger, 'error', ' server error(live)! status_code: {}'.format(res.status_code), 'server error(live)! status_code: {0} \n message: {1}'.format(res.status_code, res.text))
+      else:
+        data.extend(res.json()['data'])
+    return data
+
+  # live streamers waiting for quality check. stream info of stream.online is None until probe()
+  def check_live(self) -> dict:
+    try:
+      info = dict()
+      if len(self.offline) > 0:
+        for i in self.fetch_streams():
+          if i['user_login'] in self.offline:
+            info[i['user_login']] = {'title': i['title'], 'game': i['game_name']}
+            self.detected(i['user_login'])
+        self.drain_push_events()
+        for id in list(self.pushed):
+          if self.checking(id) is False:
+            self.pushed.discard(id)
+          elif id not in info:
+            info[id] = self.streamers[id].push_info
     except requests.exceptions.ConnectionError as ce:
       self.print_log(self.logger, 'error', " requests.exceptions.ConnectionError. Go back checking...", f'{type(ce).__name__}: {ce}')
       info = {}
@@ -208,163 +1632,812 @@ class TwitchLiveCheck:
       info = {}
     return info
 
+  # check the quality of live streamers at the same time and start recording as each check finishes
+  def probe_streams(self, info: dict) -> None:
+    if self.recording_full():
+      return
+    for id in info:
+      self.start_probe(id)
+    futures = {self.probe_pool.submit(self.probe, id, info[id]): id for id in info}
+    for future in as_completed(futures):
+      id = futures[future]
+      try:
+        live, stream_info = future.result()
+      except requests.exceptions.ConnectionError as ce:
+        self.print_log(self.logger, 'error', " requests.exceptions.ConnectionError. Go back checking...", f'{type(ce).__name__}: {ce}')
+        live, stream_info = False, None
+      except requests.exceptions.ReadTimeout as rt:
+        self.print_log(self.logger, 'error', " requests.exceptions.ReadTimeout. Go back checking...", f'{type(rt).__name__}: {rt}')
+        live, stream_info = False, None
+      except Exception as e:   # a bad response of one streamer. the other probes keep running
+        self.probe_error(id, e)
+        live, stream_info = False, None
+      self.finish_probe(id, live, stream_info)
+
+  def probe(self, id, stream_info) -> tuple:
+    live = self.check_quality(id)
+    if live and stream_info is None:
+      stream_info = self.request_channel_info(id)
+    return live, stream_info
+
+  # gql errors, broken json, ... the streamer goes back to checking
+  def probe_error(self, id, error: Exception) -> None:
+    self.print_log(self.logger, 'error', ' {} quality check error. Go back checking...'.format(id), '{} quality check. {}: {}\n{}'.format(id, type(error).__name__, error, ''.join(traceback.format_exception(type(error), error, error.__traceback__))))
+
+  # offline -> probing. the streamer stays in its helix batch
+  def start_probe(self, id) -> None:
+    self.probing.add(id)
+    self.offline.discard(id)
+
+  # probing -> recording, or back to offline
+  def finish_probe(self, id, live: bool, stream_info) -> None:
+    self.probing.discard(id)
+    state = self.streamers[id]
+    if live and self.recording_full():
+      self.print_log(self.logger, 'info', None, '{} is online. but {} streams are already being recorded.'.format(id, len(self.recording)))
+    elif live and state.batch is not None and self.owns(id):
+      self.remove_from_batch(id)
+      self.pushed.discard(id)
+      self.start_record(id, stream_info)
+      return
+    elif id in self.pushed and state.check_num >= self.check_max:
+      self.pushed.discard(id)   # leave it to helix
+      state.detect_time = None
+    if state.batch is not None:
+      self.offline.add(id)
+    if state.proc is None:
+      state.upgrade = None
+    if id not in self.pushed:
+      state.resume = False   # the stream has ended. the next live stream is a go-live
+
+  def detected(self, id) -> None:
+    state = self.streamers[id]
+    if state.detect_time is None:
+      state.detect_time = time.time()
+
+  # check the streamer without waiting for helix
+  def push(self, id, stream_info) -> None:
+    if id not in self.pushed:
+      self.streamers[id].push_info = stream_info
+      self.pushed.add(id)
+    self.detected(id)
+
+  def drain_push_events(self) -> None:
+    while True:
+      try:
+        id = self.push_events.get_nowait()
+      except queue.Empty:
+        break
+      if id in self.streamers:
+        self.push(id, None)
+
   def loop_check(self) -> None:
-    escape_str = ['\\', '/', ':', '*', '?', '\"', '<', '>', '|', '\a', '\b', '\f', '\n', '\r', '\t', r'\v', r'\u', r'\x', r'\N', r'\U', '\f\r', '\r\n', '\x1c', '\x1d', '\x1e', '\x85', '\u2028', '\u2029']
     while True:
+      self.apply_controls()
+      self.apply_shards()
       info = self.check_live()
       if info != {}:
-        for id in info:
-          print('', id, 'is online. Stream recording in session.')
-          if(pathlib.Path(self.download_path[id]).is_dir() is False):
-            pathlib.Path(self.download_path[id]).mkdir(parents=True, exist_ok=True)
-          title = info[id]['title'].replace('}', '}}').replace('{', '{{') if info[id]['title'].replace(' ', '') != '' else 'Untitled'
-          title = "".join(x for x in title if x not in escape_str)
-          game = info[id]['game'] if info[id]['game'] != '' else 'Null'
-          game = "".join(x for x in game if x not in escape_str)
-          game = '-'.join((game, self.available_quality[id])) if self.quality_in_title else game
-          filename = '{}-{}_{}_{}.ts'.format(id, datetime.datetime.now().strftime("%Y%m%d_%Hh%Mm%Ss"), title, game)
-          file_path = pathlib.Path(self.download_path[id]).joinpath(filename)
-          print(file_path)
-          
-          self.procs[id] = subprocess.Popen(self.streamlink_args + ['www.twitch.tv/' + id, self.stream_quality[id], "-o", file_path])  #return code: 3221225786, 130
-          self.available_quality.pop(id, 0)
-          self.print_log(self.logger, 'info', None, '{} stream recording in session.'.format(id))
-      if self.streamerID != []:
-        print('', self.streamerID, 'is offline. Check again in', self.refresh, 'seconds.')
-        #print('Now Online:', list(self.procs.keys()))
+        self.probe_streams(info)
+      self.print_status()
       self.check_process()
-      time.sleep(self.refresh)
+      self.wait_exit_events(self.tick())
+
+  def start_record(self, id, stream_info: dict, upgrade=False) -> None:
+    escape_str = ['\\', '/', ':', '*', '?', '\"', '<', '>', '|', '\a', '\b', '\f', '\n', '\r', '\t', r'\v', r'\u', r'\x', r'\N', r'\U', '\f\r', '\r\n', '\x1c', '\x1d', '\x1e', '\x85', '\u2028', '\u2029']
+    state = self.streamers[id]
+    if upgrade:
+      self.echo('', id, state.available_quality, 'quality is found. Switch recording to a new file.')
+    else:
+      self.echo('', id, 'is online. Stream recording in session.')
+      if state.resume is False:
+        self.record_live(id)
+      state.resume = False
+    if(state.download_path.is_dir() is False):
+      state.download_path.mkdir(parents=True, exist_ok=True)
+    title = stream_info['title'].replace('}', '}}').replace('{', '{{') if stream_info['title'].replace(' ', '') != '' else 'Untitled'
+    title = "".join(x for x in title if x not in escape_str)
+    game = stream_info['game'] if stream_info['game'] != '' else 'Null'
+    game = "".join(x for x in game if x not in escape_str)
+    game = '-'.join((game, state.available_quality)) if self.quality_in_title else game
+    filename = '{}-{}_{}_{}.ts'.format(id, datetime.datetime.now().strftime("%Y%m%d_%Hh%Mm%Ss"), title, game)
+    file_path = state.download_path.joinpath(filename)
+    self.echo(file_path)
+
+    state.proc = self.launch_recorder(id, file_path)
+    self.recording.add(id)
+    state.record_info = {'detected': state.detect_time or time.time(), 'started': time.time(), 'file': file_path, 'size': 0, 'stream_info': stream_info}
+    state.detect_time = None
+    if self.journal is not None:
+      state.record_info['journal_id'] = self.journal.start(id, file_path.resolve(), state.available_quality, stream_info, getattr(state.proc, 'pid', None))
+    self.watch_recorder(id, state.proc)
+    state.available_quality = None
+    self.print_log(self.logger, 'info', None, '{} stream recording in session.'.format(id))
+
+  def launch_recorder(self, id, file_path: pathlib.Path):
+    variant_url = None
+    quality = self.streamers[id].available_quality
+    if self.recorder == 'native':
+      variant_url = self.variant_url(id) or self.resolve_variant(id, quality)
+    if variant_url is not None:
+      return self.hls_recorder.record(variant_url, file_path, resolve=lambda: self.resolve_variant(id, quality))
+    args = self.streamlink_args + self.recorder_input(id) + ["-o", file_path]
+    proc = self.recorder_workers.launch(args) if self.recorder_workers is not None else None
+    return proc or subprocess.Popen(args)  #return code: 3221225786, 130
+
+  def recorder_worker_command(self) -> list:
+    if getattr(sys, 'frozen', False):
+      return [sys.executable, '--recorder-worker']
+    return [sys.executable, str(pathlib.Path(__file__).resolve()), '--recorder-worker']
+
+  # hand the variant playlist resolved by check_quality() to streamlink. if it has expired, streamlink resolves the twitch url again
+  def recorder_input(self, id) -> list:
+    variant_url = self.variant_url(id)
+    if self.direct_hls and variant_url is not None:
+      return ['hls://' + variant_url, 'best']
+    return ['www.twitch.tv/' + id, 'best' if self.streamers[id].upgrade is not None else self.streamers[id].quality]
+
+  # variant playlist url of the available quality, None if it has expired
+  def variant_url(self, id) -> str:
+    variant = self.find_variant(id, self.streamers[id].available_quality)
+    return variant.url if variant is not None else None
+
+  # variant of the cached master playlist, None if it has expired
+  def find_variant(self, id, quality) -> Variant:
+    playlist = self.streamers[id].playlist
+    if playlist is None or time.time() >= playlist['expire'] - self.timeout:
+      return None
+    return next((variant for variant in playlist['variants'] if variant.name == quality), None)
+
+  # parse the master playlist once and share it with quality check, title and recorder
+  def cache_playlist(self, id, m3u8: str, access_token: dict) -> list:
+    variants = master_playlist_parser(m3u8)
+    self.streamers[id].playlist = {'variants': variants, 'expire': int(json.loads(access_token['value'])['expires'])}
+    return variants
+
+  # get the variant playlist url again. used by the native recorder at start and when the url has expired
+  def resolve_variant(self, id, quality) -> str:
+    try:
+      access_token = self.get_pat(id)
+      if access_token is None:
+        return None
+      m3u8_data = self.request_usher(id, access_token)
+    except requests.exceptions.RequestException as rqe:
+      self.print_log(self.logger, 'error', None, f'variant playlist of {id}. {type(rqe).__name__}: {rqe}')
+      return None
+    if m3u8_data.status_code != requests.codes.ok:
+      return None
+    variants = self.cache_playlist(id, m3u8_data.text, access_token)
+    variant = next((variant for variant in variants if variant.name == quality), None) or next((variant for variant in variants if variant.name != 'audio_only'), None)
+    return variant.url if variant is not None else None
+
+  def request_usher(self, id, access_token: dict, headers=None) -> requests.Response:
+    url_usher = self.usher_url.format(id)
+    params_usher = {'client_id':'kimne78kx3ncx6brgo4mv6wki5h1ko', 'token': access_token['value'], 'sig': access_token['signature'], 'allow_source': True, 'allow_audio_only': True}
+    start = time.monotonic()
+    res = self.request('GET', url_usher, params=params_usher, headers={'user-agent': 'Mozilla/5.0', **(headers or {})}, timeout= self.timeout)
+    self.metrics.observe('twitch_probe_request_seconds', time.monotonic() - start, endpoint='usher')
+    return res
+
+  # asyncio engine: a slow quality check of one streamer doesn't delay the others
+  async def async_loop_check(self) -> None:
+    self.probe_queue = asyncio.Queue()
+    tasks = [asyncio.create_task(self.async_poll()), asyncio.create_task(self.async_supervise())]
+    tasks.extend(asyncio.create_task(self.async_probe()) for _ in range(self.probe_workers))
+    await asyncio.gather(*tasks)
+
+  async def async_poll(self) -> None:
+    while True:
+      self.apply_controls()
+      self.apply_shards()
+      if len(self.offline) > 0:
+        for i in await asyncio.to_thread(self.fetch_streams):
+          if i['user_login'] in self.offline and self.recording_full() is False:
+            self.start_probe(i['user_login'])
+            self.probe_queue.put_nowait((i['user_login'], {'title': i['title'], 'game': i['game_name']}))
+            self.detected(i['user_login'])
+        self.drain_push_events()
+        for id in list(self.pushed):
+          if self.checking(id) is False:
+            self.pushed.discard(id)
+          elif id in self.offline and self.recording_full() is False:
+            self.start_probe(id)
+            self.probe_queue.put_nowait((id, self.streamers[id].push_info))
+      self.print_status()
+      await asyncio.sleep(self.tick())
+
+  async def async_probe(self) -> None:
+    while True:
+      id, stream_info = await self.probe_queue.get()
+      try:
+        live, stream_info = await asyncio.to_thread(self.probe, id, stream_info)
+      except requests.exceptions.ConnectionError as ce:
+        self.print_log(self.logger, 'error', " requests.exceptions.ConnectionError. Go back checking...", f'{type(ce).__name__}: {ce}')
+        live = False
+      except requests.exceptions.ReadTimeout as rt:
+        self.print_log(self.logger, 'error', " requests.exceptions.ReadTimeout. Go back checking...", f'{type(rt).__name__}: {rt}')
+        live = False
+      except Exception as e:   # a bad response of one streamer. the other probes and the engine keep running
+        self.probe_error(id, e)
+        live = False
+      self.finish_probe(id, live, stream_info)
+      self.probe_queue.task_done()
+
+  async def async_supervise(self) -> None:
+    while True:
+      self.check_process()
+      try:
+        id, proc, proc_code = await asyncio.to_thread(self.exit_events.get, True, self.refresh)
+      except queue.Empty:
+        continue
+      self.handle_exit(id, proc, proc_code)
+
+  def start_eventsub(self) -> None:
+    if websocket is None:
+      self.print_log(self.logger, 'error', 'websocket-client is not installed. check streams with helix only', 'eventsub: no websocket-client')
+      return
+    if self.eventsub_token == '':
+      self.print_log(self.logger, 'error', 'Please enter the EventSub user access token. check streams with helix only', 'eventsub: no user access token')
+      return
+    self.get_user_ids()
+    self.eventsub_started = True
+    threading.Thread(target=self.eventsub_loop, name='eventsub', daemon=True).start()
+
+  # streamer added by the control api. subscribed right away if the session is connected, otherwise with the next session
+  def eventsub_add(self, id) -> None:
+    try:
+      self.get_user_ids([id])
+      session_id = self.eventsub_session_id
+      if session_id is not None:
+        self.eventsub_subscribe(session_id, [id])
+        self.retier(force=True)
+    except requests.exceptions.RequestException as rqe:
+      self.print_log(self.logger, 'error', None, f'eventsub: {id} not subscribed. {type(rqe).__name__}: {rqe}')
+
+  def get_user_ids(self, streamers=None) -> None:
+    h = {'Authorization': f'Bearer {self.user_token}', 'Client-Id': self.client_id}
+    streamers = streamers or list(self.streamers)   # with self.shard_store, the streamers of shards claimed later too
+    for num in range(0, len(streamers), self.helix_batch_size):
+      api = self.helix_url + '/users?' + '&'.join(f'login={id}' for id in streamers[num:num + self.helix_batch_size])
+      res = self.get_session(api).get(api, headers=h, timeout= self.timeout)
+      if res.status_code != requests.codes.ok:
+        self.print_log(self.logger, 'error', ' server error(users)! status_code: {}'.format(res.status_code), 'server error(users)! status_code: {0} \n message: {1}'.format(res.status_code, res.text))
+        continue
+      for user in res.json()['data']:
+        if user['login'] in self.streamers:
+          self.streamers[user['login']].user_id = user['id']
+
+  # stream.online has no title and category
+  def request_channel_info(self, id) -> dict:
+    stream_info = {'title': '', 'game': ''}
+    user_id = self.streamers[id].user_id
+    if user_id is None:
+      return stream_info
+    api = self.helix_url + '/channels?broadcaster_id=' + user_id
+    h = {'Authorization': f'Bearer {self.user_token}', 'Client-Id': self.client_id}
+    try:
+      res = self.get_session(api).get(api, headers=h, timeout= self.timeout)
+      if res.status_code == requests.codes.ok and res.json()['data'] != []:
+        stream_info = {'title': res.json()['data'][0]['title'], 'game': res.json()['data'][0]['game_name']}
+    except requests.exceptions.RequestException as rqe:
+      self.print_log(self.logger, 'error', None, f'channel info of {id}. {type(rqe).__name__}: {rqe}')
+    return stream_info
+
+  # keep the EventSub WebSocket connected. while it is disconnected, the subscribed streamers go back to the helix tiers
+  def eventsub_loop(self) -> None:
+    url = self.eventsub_url
+    delay = 1
+    while True:
+      reconnect_url = None
+      try:
+        ws = websocket.create_connection(url, timeout= self.timeout)
+        try:
+          reconnect_url = self.eventsub_session(ws, url != self.eventsub_url)
+          delay = 1
+        finally:
+          ws.close()
+      except (websocket.WebSocketException, OSError, ValueError, KeyError) as we:
+        self.print_log(self.logger, 'error', ' EventSub disconnected. check streams with helix...', f'eventsub. {type(we).__name__}: {we}')
+      if reconnect_url is None:
+        self.set_eventsub_state(False)
+        url = self.eventsub_url
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
+      else:
+        url = reconnect_url
+
+  # return the reconnect url of session_reconnect message
+  def eventsub_session(self, ws, reconnected: bool) -> str:
+    message_ids = []
+    while True:
+      message = json.loads(ws.recv())
+      message_type = message['metadata']['message_type']
+      if message['metadata']['message_id'] in message_ids:
+        continue
+      message_ids = message_ids[-99:] + [message['metadata']['message_id']]
+
+      if message_type == 'session_welcome':
+        session = message['payload']['session']
+        ws.settimeout(session['keepalive_timeout_seconds'] + self.timeout)   # no message until timeout : connection lost
+        self.eventsub_session_id = session['id']
+        if reconnected is False:
+          self.eventsub_subscribe(session['id'])
+        self.set_eventsub_state(True)
+      elif message_type == 'notification':
+        id = message['payload']['event']['broadcaster_user_login']
+        if message['payload']['subscription']['type'] == 'stream.online':
+          self.print_log(self.logger, 'info', f' {id} stream.online event', f'eventsub: {id} stream.online')
+          self.push_events.put(id)
+      elif message_type == 'session_reconnect':
+        return message['payload']['session']['reconnect_url']
+      elif message_type == 'revocation':
+        subscription = message['payload']['subscription']
+        self.print_log(self.logger, 'error', None, 'eventsub: subscription revoked. {}'.format(subscription))
+        if subscription['type'] == 'stream.online':
+          self.eventsub_subscribed.difference_update(id for id, state in list(self.streamers.items()) if state.user_id == subscription['condition']['broadcaster_user_id'])
+          self.retier(force=True)
+
+  # ids None : every streamer of a new session
+  def eventsub_subscribe(self, session_id, ids=None) -> None:
+    api = self.helix_url + '/eventsub/subscriptions'
+    h = {'Authorization': f'Bearer {self.eventsub_token}', 'Client-Id': self.client_id}
+    if ids is None:
+      self.eventsub_subscribed = set()
+      ids = list(self.streamers)
+    for id in ids:
+      state = self.streamers.get(id)
+      if state is None or state.user_id is None:
+        continue
+      for subscription_type in self.eventsub_types:
+        payload = {'type': subscription_type, 'version': '1', 'condition': {'broadcaster_user_id': state.user_id}, 'transport': {'method': 'websocket', 'session_id': session_id}}
+        res = self.get_session(api).post(api, json=payload, headers=h, timeout= self.timeout)
+        if res.status_code == requests.codes.accepted:
+          if subscription_type == 'stream.online':
+            self.eventsub_subscribed.add(id)
+        else:
+          # too_many_requests : subscription limit or max cost exceeded. the others are checked with helix
+          self.print_log(self.logger, 'error', ' EventSub subscription failed! status_code: {}'.format(res.status_code), 'eventsub subscription failed! status_code: {0} \n message: {1}'.format(res.status_code, res.text))
+          return
+    self.print_log(self.logger, 'info', ' EventSub subscribed {} streamers'.format(len(self.eventsub_subscribed)))
+
+  def set_eventsub_state(self, connected: bool) -> None:
+    if connected is False:
+      self.eventsub_session_id = None
+    if self.eventsub_connected != connected:
+      self.eventsub_connected = connected
+      self.retier(force=True)
 
   def check_quality(self, id) -> bool:
-    # bypass quality check
-    if self.stream_quality[id] == 'audio_only':
-      self.available_quality[id] = 'audio_only'
+    state = self.streamers[id]
+    # bypass quality check. self.direct_hls and the native recorder need the variant playlist. a resumed stream may have ended
+    if ((self.direct_hls or self.recorder == 'native') and self.legacy_func is False) or state.resume:
+      pass
+    elif state.quality == 'audio_only':
+      state.available_quality = 'audio_only'
       return True
-    elif self.quality_in_title == False and self.stream_quality[id] in ['best', 'worst']:
-      self.available_quality[id] = self.stream_quality[id]
+    elif self.quality_in_title == False and state.quality in ['best', 'worst']:
+      state.available_quality = state.quality
       return True
-    elif self.stream_quality[id] in ['best', 'worst'] and id in self.available_quality:
+    elif state.quality in ['best', 'worst'] and state.available_quality is not None:
       return True
 
     if self.legacy_func == True:
-      # previous code
-      proc = subprocess.run(self.streamlink_quality_args + ['www.twitch.tv/' + id], stdout=subprocess.PIPE, universal_newlines=True)
-      streamlink_quality = proc.stdout.split('\n')[-2].split(': ')[-1].replace(' (worst)', '').replace(' (best)', '').replace('audio_only, ', '').split(', ')
+      streamlink_quality = self.legacy_quality(id)
       self.print_log(self.logger, 'info', None, 'Available streamlink quality of {} : {}'.format(id, streamlink_quality))
 
       if streamlink_quality == []:
-        self.check_num[id] += 1
+        self.quality_retry(id)
         return False
-      elif self.stream_quality[id] in ['best', 'worst']:
-        self.available_quality[id] = streamlink_quality[-1] if self.stream_quality[id] == 'best' else streamlink_quality[0]
+      elif state.quality in ['best', 'worst']:
+        state.available_quality = streamlink_quality[-1] if state.quality == 'best' else streamlink_quality[0]
         return True
       # if the desired stream quality is not available
-      elif self.stream_quality[id] not in streamlink_quality:
-        self.check_num[id] += 1
-        print('', id, "stream is online. but", self.stream_quality[id], "quality could not be found. Check:", self.check_num[id])
+      elif state.quality not in streamlink_quality:
+        self.quality_retry(id)
+        self.echo('', id, "stream is online. but", state.quality, "quality could not be found. Check:", state.check_num)
         
-        if self.check_num[id] >= self.check_max:
-          self.stream_quality[id] = 'best'
-          self.available_quality[id] = streamlink_quality[-1]
+        if state.check_num >= self.check_max:
+          state.quality = 'best'
+          state.available_quality = streamlink_quality[-1]
           self.print_log(self.logger, 'info', 'Change {} stream quality to best.'.format(id))
-          self.check_num[id] = 0
+          state.check_num = 0
           return True
         return False
       # desired stream quality is available
       else:
-        self.available_quality[id] = self.stream_quality[id]
-        self.check_num[id] = 0
+        state.available_quality = state.quality
+        state.check_num = 0
         return True
 
     else:
-      twitch_headers = {'Client-id': 'kimne78kx3ncx6brgo4mv6wki5h1ko', 'user-agent': 'Mozilla/5.0'}
-      url_gql = 'https://gql.twitch.tv/gql'
-      url_usher = 'https://usher.ttvnw.net/api/channel/hls/{}.m3u8'.format(id)
-      stream_token_query = {"operationName": "PlaybackAccessToken", "extensions": {"persistedQuery": {"version": 1, "sha256Hash": "0828119ded1c13477966434e15800ff57ddacf13ba1911c129dc2200705b0712"}}, "variables": {"isLive": True, "login": str(id), "isVod": False, "vodID": '', "playerType": "embed"}}
-      
       # get playback access token and get m3u8
-      if id in self.pat:
-        if int(time.time()) >= self.pat[id]['expire']:
-          self.print_log(self.logger, 'info', '', 'Get new PAT for {}.'.format(id))
-          self.pat.pop(id, 0)
-
-      if id not in self.pat:
-        playback_token = requests.post(url_gql,json=stream_token_query, headers=twitch_headers, proxies=self.proxies, timeout= self.timeout)
-        if playback_token.status_code != requests.codes.ok:
-          self.check_num[id] += 1
-          return False
-        else:
-          access_token = playback_token.json()['data']['streamPlaybackAccessToken']
-          try:
-            token_expire = int(access_token['value'].split(',')[11].split(':')[1])
-            self.pat[id] = {'token': access_token, 'expire': token_expire}
-          except ValueError:
-            if id in self.pat:
-              del self.pat[id]
-            self.print_log(self.logger, 'error', 'PAT expiration time error, Change self.legacy_func to True', 'ValueError: token_expire_time')
-            self.legacy_func = True
-            pass
-      params_usher = {'client_id':'kimne78kx3ncx6brgo4mv6wki5h1ko', 'token': self.pat[id]['token']['value'], 'sig': self.pat[id]['token']['signature'], 'allow_source': True, 'allow_audio_only': True}
-      m3u8_data = requests.get(url_usher, params=params_usher, headers={'user-agent': 'Mozilla/5.0'}, proxies=self.proxies, timeout= self.timeout)
-      live_quality = self.quality_parser(m3u8_data.text)
+      access_token = self.get_pat(id)
+      if access_token is None:
+        self.quality_retry(id)
+        return False
+      m3u8_data = self.request_usher(id, access_token)
+      variants = self.cache_playlist(id, m3u8_data.text, access_token) if m3u8_data.status_code == requests.codes.ok else []
+      live_quality = [variant.name for variant in variants if variant.name != 'audio_only']
       self.print_log(self.logger, 'info', None, 'Available ttvnw quality of {} : {}'.format(id, live_quality))
 
-      if live_quality == []:
-        self.check_num[id] += 1
+      if state.quality == 'audio_only' and 'audio_only' in [variant.name for variant in variants]:
+        state.available_quality = 'audio_only'
+        return True
+      elif live_quality == []:
+        self.quality_retry(id)
         return False
-      elif self.stream_quality[id] in ['best', 'worst']:
-        self.available_quality[id] = live_quality[0] if self.stream_quality[id] == 'best' else live_quality[-1]
+      elif state.quality in ['best', 'worst']:
+        state.available_quality = live_quality[0] if state.quality == 'best' else live_quality[-1]
         return True
       # desired stream quality is available
-      elif self.stream_quality[id] in live_quality:
-        self.available_quality[id] = self.stream_quality[id]
-        self.check_num[id] = 0
+      elif state.quality in live_quality:
+        state.available_quality = state.quality
+        state.check_num = 0
         return True
       # if the desired stream quality is not available
+      elif self.upgrade_quality:
+        # record the best quality until the desired quality appears. check_upgrades() watches the master playlist
+        state.upgrade = {'quality': state.quality, 'due': time.time() + self.upgrade_interval, 'future': None, 'etag': m3u8_data.headers.get('ETag'), 'digest': self.media_digest(m3u8_data.text)}
+        state.available_quality = live_quality[0]
+        self.echo('', id, "stream is online. but", state.quality, "quality could not be found. Record with", live_quality[0], "until it appears.")
+        return True
       else:
-        self.check_num[id] += 1
-        print('', id, "stream is online. but", self.stream_quality[id], "quality could not be found. Check:", self.check_num[id])
+        self.quality_retry(id)
+        self.echo('', id, "stream is online. but", state.quality, "quality could not be found. Check:", state.check_num)
 
-        if self.check_num[id] >= self.check_max:
-          self.stream_quality[id] = 'best'
-          self.available_quality[id] = live_quality[0]
+        if state.check_num >= self.check_max:
+          state.quality = 'best'
+          state.available_quality = live_quality[0]
           self.print_log(self.logger, 'info', 'Change {} stream quality to best.'.format(id))
-          self.check_num[id] = 0
+          state.check_num = 0
           return True
         return False
 
+  # stream names of streamlink from worst to best, without audio_only
+  def legacy_quality(self, id) -> list:
+    session = self.get_streamlink_session()
+    if session is None:
+      # previous code
+      proc = subprocess.run(self.streamlink_quality_args + ['www.twitch.tv/' + id], stdout=subprocess.PIPE, universal_newlines=True)
+      return proc.stdout.split('\n')[-2].split(': ')[-1].replace(' (worst)', '').replace(' (best)', '').replace('audio_only, ', '').split(', ')
+    try:
+      streams = session.streams('www.twitch.tv/' + id)
+    except streamlink.StreamlinkError as se:
+      self.print_log(self.logger, 'error', None, f'streamlink quality of {id}. {type(se).__name__}: {se}')
+      return []
+    names = [name for name in streams if name not in ('best', 'worst', 'audio_only') and name.endswith('-unfiltered') is False]
+    return sorted(names, key=StreamlinkPlugin.stream_weight)
+
+  # one streamlink session for every legacy quality check, instead of a streamlink process for each check. None if streamlink is not importable
+  def get_streamlink_session(self):
+    if self.streamlink_session is not None or streamlink is None:
+      return self.streamlink_session
+    with self.session_lock:
+      if self.streamlink_session is None:
+        session = streamlink.Streamlink()
+        if self.proxies is not None:
+          session.set_option('http-proxy', self.proxies['https'])
+        self.streamlink_session = session
+    return self.streamlink_session
+
+  def quality_retry(self, id) -> None:
+    self.streamers[id].check_num += 1
+    self.metrics.inc('twitch_quality_retries_total')
+
+  # playback access token from the cache. pat_refresh_loop() renews it before it expires
+  def get_pat(self, id) -> dict:
+    state = self.streamers.get(id)
+    pat = state.pat if state is not None else None
+    if pat is not None:
+      if time.time() < pat['expire']:
+        return pat['token']
+      self.print_log(self.logger, 'info', '', 'Get new PAT for {}.'.format(id))
+    return self.fetch_pat(id)
+
+  def fetch_pat(self, id) -> dict:
+    twitch_headers = {'Client-id': 'kimne78kx3ncx6brgo4mv6wki5h1ko', 'user-agent': 'Mozilla/5.0'}
+    url_gql = self.gql_url
+    stream_token_query = {"operationName": "PlaybackAccessToken", "extensions": {"persistedQuery": {"version": 1, "sha256Hash": "0828119ded1c13477966434e15800ff57ddacf13ba1911c129dc2200705b0712"}}, "variables": {"isLive": True, "login": str(id), "isVod": False, "vodID": '', "playerType": "embed"}}
+    start = time.monotonic()
+    playback_token = self.request('POST', url_gql, json=stream_token_query, headers=twitch_headers, timeout= self.timeout)
+    self.metrics.observe('twitch_probe_request_seconds', time.monotonic() - start, endpoint='gql')
+    if playback_token.status_code != requests.codes.ok:
+      return None
+    try:
+      access_token = (playback_token.json().get('data') or {}).get('streamPlaybackAccessToken')
+    except (ValueError, AttributeError):
+      access_token = None
+    state = self.streamers.get(id)
+    if access_token is None or access_token.get('value') is None:
+      # gql errors, banned or renamed channel. only this streamer has no PAT
+      if state is not None:
+        state.pat = None
+      self.print_log(self.logger, 'error', None, 'no PAT for {}. {}'.format(id, playback_token.text[:200]))
+      return None
+    try:
+      token_expire = int(json.loads(access_token['value'])['expires'])
+    except (ValueError, KeyError, TypeError):
+      if state is not None:
+        state.pat = None
+      self.print_log(self.logger, 'error', 'PAT expiration time error, Change self.legacy_func to True', 'ValueError: token_expire_time')
+      self.legacy_func = True
+      return None
+    if state is not None:
+      state.pat = {'token': access_token, 'expire': token_expire}
+      with self.pat_lock:
+        self.pat_changed = True
+    return access_token
+
+  # renew the PAT of streamers that are likely to be checked soon : 'hot' tier, stream.online and quality retry
+  def pat_refresh_loop(self) -> None:
+    while self.legacy_func is False:
+      time.sleep(self.pat_refresh_interval)
+      with self.batch_lock:
+        candidates = [self.streamers[id] for num, batch in enumerate(self.batches) for id in batch if self.batch_tier[num] == 'hot' or id in self.pushed or self.streamers[id].check_num > 0]
+      now = time.time()
+      for state in candidates[:self.pat_prefetch_max]:
+        id = state.id
+        pat = state.pat
+        if pat is None or pat['expire'] - now < self.pat_refresh_margin:
+          try:
+            self.fetch_pat(id)
+          except requests.exceptions.RequestException as rqe:
+            self.print_log(self.logger, 'error', None, f'PAT refresh of {id}. {type(rqe).__name__}: {rqe}')
+          except Exception as e:   # keep prefetching the other PATs
+            self.print_log(self.logger, 'error', None, 'PAT refresh of {}. {}: {}\n{}'.format(id, type(e).__name__, e, traceback.format_exc()))
+      try:
+        self.save_pat_cache()
+      except (OSError, sqlite3.Error) as oe:
+        self.print_log(self.logger, 'error', None, f'PAT cache. {type(oe).__name__}: {oe}')
+
+  def load_pat_cache(self) -> None:
+    if self.journal is not None:
+      cache = self.journal.load_pats()
+    else:
+      cache = self.read_pat_cache()
+    now = time.time()
+    for id in cache:
+      if id in self.streamers and cache[id]['expire'] - now > self.pat_refresh_margin:
+        self.streamers[id].pat = cache[id]
+
+  def save_pat_cache(self) -> None:
+    with self.pat_lock:
+      if self.pat_changed is False:
+        return
+      pats = {id: state.pat for id, state in list(self.streamers.items()) if state.pat is not None}
+      self.pat_changed = False
+    if self.journal is not None:
+      self.journal.save_pats(pats)
+      return
+    now = time.time()
+    cache = {id: pat for id, pat in self.read_pat_cache().items() if pat['expire'] > now}   # other instances with the same self.cache_path share the file
+    cache.update(pats)
+    cache_file = self.cache_path.joinpath('pat_cache.json')
+    temp_file = cache_file.with_suffix('.{}.tmp'.format(getpid()))
+    temp_file.write_text(json.dumps(cache), encoding='utf-8')
+    temp_file.replace(cache_file)
+
+  def read_pat_cache(self) -> dict:
+    try:
+      return json.loads(self.cache_path.joinpath('pat_cache.json').read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+      return {}
+
+  # exits are handled as soon as watch_recorder() reports them. poll() here is the fallback
   def check_process(self) -> None:
-    id_status = False
-    if self.procs != {}:
-      for id in list(self.procs.keys()):
-        proc_code = self.procs[id].poll()
-        if proc_code == None:
-          # 실행 중
-          pass
-        elif proc_code == 0:
-          # 정상 종료
-          #print('', id, "stream is done. Go back checking...")
-          del self.procs[id]
-          self.streamerID.append(id)
-          self.stream_quality[id] = self.quality_by_streamer[id]
-          self.print_log(self.logger, 'info', ' {} stream is done. Go back checking...'.format(id), '{} stream is done. status: {}'.format(id, proc_code))
-          id_status = True
-        else:
-          # 비정상 종료
-          #print('', id, "stream error. Error code:", proc_code)
-          del self.procs[id]
-          self.streamerID.append(id)
-          self.stream_quality[id] = self.quality_by_streamer[id]
-          self.print_log(self.logger, 'info', ' {} stream error. Error code: {}'.format(id, proc_code), '{} stream is done. status: {}'.format(id, proc_code))
-          id_status = True
-    if id_status is True:
-      self.url_params = self.create_params(self.streamerID)
-      id_status = False
+    for id in list(self.recording):
+      proc = self.streamers[id].proc
+      self.check_record_size(id)
+      if proc.poll() != None:
+        self.handle_exit(id, proc, proc.poll())
+    self.check_upgrades()
+    self.metrics.set('twitch_active_recorders', len(self.recording))
+    if self.post_processor is not None:
+      status = self.post_processor.status()
+      self.metrics.set('twitch_post_queue_depth', status['queued'] + len(status['running']))
+      self.metrics.set('twitch_post_jobs_total', status['finished'], result='done')
+      self.metrics.set('twitch_post_jobs_total', status['failed'], result='failed')
+
+  # check the master playlist of recordings waiting for the recording quality, without blocking the loop
+  def check_upgrades(self) -> None:
+    for id in list(self.recording):
+      upgrade = self.streamers[id].upgrade
+      if upgrade is None:
+        continue
+      if upgrade['future'] is None:
+        if time.time() >= upgrade['due']:
+          upgrade['future'] = self.probe_pool.submit(self.fetch_upgrade, id, upgrade)
+      elif upgrade['future'].done():
+        try:
+          found = upgrade['future'].result()
+        except requests.exceptions.RequestException as rqe:
+          self.print_log(self.logger, 'error', None, f'master playlist of {id}. {type(rqe).__name__}: {rqe}')
+          found = False
+        except Exception as e:   # gql errors, broken json, ... the recording continues and the playlist is checked again
+          self.print_log(self.logger, 'error', None, '{} master playlist. {}: {}\n{}'.format(id, type(e).__name__, e, ''.join(traceback.format_exception(type(e), e, e.__traceback__))))
+          found = False
+        upgrade['future'] = None
+        upgrade['due'] = time.time() + self.upgrade_interval
+        if found:
+          self.upgrade_record(id, upgrade['quality'])
+    # the replaced recordings end after self.upgrade_overlap
+    for retired in list(self.retiring):
+      proc, terminate_time, journal_id, file = retired
+      proc_code = proc.poll()
+      if proc_code is None:
+        if terminate_time is not None and time.time() >= terminate_time:
+          proc.terminate()
+          self.retiring[self.retiring.index(retired)] = (proc, None, journal_id, file)   # post-processed after it has exited
+        continue
+      if journal_id is not None:
+        self.journal.finish(journal_id, proc_code)
+      self.post_process(file)
+      self.retiring.remove(retired)
+
+  # True if the recording quality has appeared. the playlist is parsed only when its quality list has changed
+  def fetch_upgrade(self, id, upgrade: dict) -> bool:
+    access_token = self.get_pat(id)
+    if access_token is None:
+      return False
+    m3u8_data = self.request_usher(id, access_token, {'If-None-Match': upgrade['etag']} if upgrade['etag'] else None)
+    if m3u8_data.status_code != requests.codes.ok:
+      return False   # not_modified or offline
+    upgrade['etag'] = m3u8_data.headers.get('ETag')
+    digest = self.media_digest(m3u8_data.text)
+    if digest == upgrade['digest']:
+      return False
+    upgrade['digest'] = digest
+    variants = master_playlist_parser(m3u8_data.text)
+    if upgrade['quality'] not in [variant.name for variant in variants]:
+      return False
+    self.streamers[id].playlist = {'variants': variants, 'expire': int(json.loads(access_token['value'])['expires'])}
+    return True
+
+  # the variant urls change with every request. only the quality list is compared
+  def media_digest(self, m3u8: str) -> int:
+    return hash(tuple(m3u8_line for m3u8_line in m3u8.split('\n') if m3u8_line.startswith('#EXT-X-MEDIA')))
+
+  # start the recording of the desired quality in a new file. the old one is terminated after self.upgrade_overlap
+  def upgrade_record(self, id, quality) -> None:
+    state = self.streamers[id]
+    state.upgrade = None
+    old_proc = state.proc
+    self.check_record_size(id)
+    journal_id = state.record_info.get('journal_id')
+    old_file = state.record_info['file']
+    state.available_quality = quality
+    self.start_record(id, state.record_info['stream_info'], upgrade=True)
+    self.retiring.append((old_proc, time.time() + self.upgrade_overlap, journal_id, old_file))
+
+  def watch_recorder(self, id, proc) -> None:
+    def wait() -> None:
+      self.exit_events.put((id, proc, proc.wait()))
+    threading.Thread(target=wait, name='watch_{}'.format(id), daemon=True).start()
+
+  # handle exit events until timeout, instead of time.sleep()
+  def wait_exit_events(self, timeout) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+      try:
+        id, proc, proc_code = self.exit_events.get(timeout=max(0, deadline - time.monotonic()))
+      except queue.Empty:
+        return
+      self.handle_exit(id, proc, proc_code)
+
+  def handle_exit(self, id, proc, proc_code) -> None:
+    state = self.streamers.get(id)
+    if state is None or state.proc is not proc:
+      return   # already handled
+    self.check_record_size(id)
+    record_info = state.record_info
+    state.proc = state.record_info = None
+    self.recording.discard(id)
+    state.upgrade = None
+    if record_info is not None and 'journal_id' in record_info:
+      self.journal.finish(record_info['journal_id'], proc_code)
+    if record_info is not None:
+      self.post_process(record_info['file'])
+    if state.watched is False:
+      del self.streamers[id]
+    elif self.owns(id):
+      self.add_to_batch(id)
+    self.metrics.inc('twitch_recorder_exits_total', code=proc_code)
+    self.metrics.set('twitch_active_recorders', len(self.recording))
+    if proc_code == 0:
+      # 정상 종료
+      self.print_log(self.logger, 'info', ' {} stream is done. Go back checking...'.format(id), '{} stream is done. status: {}'.format(id, proc_code))
+      state.fast_restarts = 0
+      return
+    # 비정상 종료
+    self.print_log(self.logger, 'info', ' {} stream error. Error code: {}'.format(id, proc_code), '{} stream is done. status: {}'.format(id, proc_code))
+    if record_info is None or proc_code in (-15, -9) or state.watched is False:
+      return
+    state.resume = True   # also when helix finds the stream again after self.restart_max
+    if time.time() - record_info['started'] > 60:
+      state.fast_restarts = 0
+    if state.fast_restarts < self.restart_max:
+      state.fast_restarts += 1
+      self.print_log(self.logger, 'info', ' {} check again and restart recording...'.format(id), '{} fast restart: {}'.format(id, state.fast_restarts))
+      self.restart_record(id, record_info['stream_info'])
+
+  # quality check right away, without waiting for helix. the recorder starts only if the stream is still live
+  def restart_record(self, id, stream_info: dict) -> None:
+    if self.async_engine:
+      if id not in self.probing:
+        self.start_probe(id)
+        self.probe_queue.put_nowait((id, stream_info))
+    else:
+      self.probe_streams({id: stream_info})
+
+  def recording_full(self) -> bool:
+    return self.max_recordings != 0 and len(self.recording) >= self.max_recordings
+
+  # bytes written and detection to first byte, from the size of the recording file
+  def check_record_size(self, id) -> None:
+    record_info = self.streamers[id].record_info if id in self.streamers else None
+    if record_info is None:
+      return
+    try:
+      size = pathlib.Path(record_info['file']).stat().st_size
+    except OSError:
+      return
+    if size > record_info['size']:
+      if record_info['size'] == 0:
+        self.metrics.observe('twitch_detection_to_first_byte_seconds', time.time() - record_info['detected'])
+      self.metrics.inc('twitch_recorded_bytes_total', size - record_info['size'], channel=id)
+      record_info['size'] = size
+
+  def start_post_processor(self) -> None:
+    remux = self.remux
+    if remux and shutil.which('ffmpeg') is None:
+      self.print_log(self.logger, 'error', 'ffmpeg is not found. finished recordings are not remuxed', 'post-processing: no ffmpeg')
+      remux = False
+    if remux is False and self.archive_path == '':
+      return
+    log = lambda message, error=False: self.print_log(self.logger, 'error' if error else 'info', message)
+    self.post_processor = PostProcessor(remux, self.archive_path, self.save_post_jobs, self.post_workers, self.post_nice, self.post_ionice, self.post_pause, lambda: len(self.recording), log)
+    atexit.register(self.post_processor.close)
+    for job in self.load_post_jobs():
+      self.post_processor.submit(job['file'], job['streamer'])
+
+  # the streamer is the name of the download directory. the recorder of the file must have exited. run=False : only saved for the next start
+  def post_process(self, file, run=True) -> None:
+    if self.post_processor is None:
+      return
+    if run:
+      self.post_processor.submit(file, pathlib.Path(file).parent.name)
+    else:
+      self.post_processor.save(file, pathlib.Path(file).parent.name)
+
+  # unfinished jobs of the previous run. with self.shard_store, only those of the shards of this instance
+  def load_post_jobs(self) -> list:
+    return [job for job in self.read_post_jobs() if self.owns(job['streamer'])]
+
+  def read_post_jobs(self) -> list:
+    if self.journal is not None:
+      return self.journal.load_post_jobs()
+    try:
+      return json.loads(self.cache_path.joinpath('post_queue.json').read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+      return []
+
+  # called by PostProcessor one at a time. the jobs of other instances with the same self.cache_path are kept
+  def save_post_jobs(self, jobs: list) -> None:
+    files = set(job['file'] for job in jobs)
+    done = self.post_files - files
+    if self.journal is not None:
+      self.journal.save_post_jobs(jobs, done)
+    else:
+      cache = [job for job in self.read_post_jobs() if job['file'] not in done and job['file'] not in files] + jobs
+      cache_file = self.cache_path.joinpath('post_queue.json')
+      temp_file = cache_file.with_suffix('.{}.tmp'.format(getpid()))
+      temp_file.write_text(json.dumps(cache), encoding='utf-8')
+      temp_file.replace(cache_file)
+    self.post_files = files   # after the save. the done jobs are removed again by the next save if it failed
 
   # modify __init__ using config file
   def change_init(self, config: ModuleType) -> bool:
-    config_version = 0.3
-    compatible_version = [0.1, 0.2, 0.3]
+    config_version = 0.4
+    compatible_version = [0.1, 0.2, 0.3, 0.4]
     if config.__version__ in compatible_version:
       self.streamerID = config.streamerID
       self.quality_by_streamer = config.quality_by_streamer
@@ -379,6 +2452,30 @@ class TwitchLiveCheck:
       self.oauth = config.oauth if config.__version__ >= 0.3 else self.oauth
       self.client_id = config.client_id
       self.client_secret = config.client_secret
+      self.pool_size = config.pool_size if config.__version__ >= 0.4 else self.pool_size
+      self.http_retries = config.http_retries if config.__version__ >= 0.4 else self.http_retries
+      self.async_engine = config.async_engine if config.__version__ >= 0.4 else self.async_engine
+      self.probe_workers = config.probe_workers if config.__version__ >= 0.4 else self.probe_workers
+      self.cache_path = config.cache_path if config.__version__ >= 0.4 else self.cache_path
+      self.direct_hls = config.direct_hls if config.__version__ >= 0.4 else self.direct_hls
+      self.recorder = config.recorder if config.__version__ >= 0.4 else self.recorder
+      self.metrics_port = config.metrics_port if config.__version__ >= 0.4 else self.metrics_port
+      self.max_recordings = config.max_recordings if config.__version__ >= 0.4 else self.max_recordings
+      self.eventsub = config.eventsub if config.__version__ >= 0.4 else self.eventsub
+      self.eventsub_token = config.eventsub_token if config.__version__ >= 0.4 else self.eventsub_token
+      self.upgrade_quality = config.upgrade_quality if config.__version__ >= 0.4 else self.upgrade_quality
+      self.recorder_pool = config.recorder_pool if config.__version__ >= 0.4 else self.recorder_pool
+      self.shard_store = config.shard_store if config.__version__ >= 0.4 else self.shard_store
+      self.control_port = config.control_port if config.__version__ >= 0.4 else self.control_port
+      self.state_journal = config.state_journal if config.__version__ >= 0.4 else self.state_journal
+      self.token_cache = config.token_cache if config.__version__ >= 0.4 else self.token_cache
+      self.json_log = config.json_log if config.__version__ >= 0.4 else self.json_log
+      self.summary_interval = config.summary_interval if config.__version__ >= 0.4 else self.summary_interval
+      self.remux = config.remux if config.__version__ >= 0.4 else self.remux
+      self.archive_path = config.archive_path if config.__version__ >= 0.4 else self.archive_path
+      self.post_workers = config.post_workers if config.__version__ >= 0.4 else self.post_workers
+      self.post_nice = config.post_nice if config.__version__ >= 0.4 else self.post_nice
+      self.post_pause = config.post_pause if config.__version__ >= 0.4 else self.post_pause
       self.print_log(self.logger, 'info', 'load the config file')
       return True
     else:
@@ -399,6 +2496,32 @@ class TwitchLiveCheck:
       logger.error('Config file is not found. Please check your config file path.')
       sys.exit('Config file is not found.')
 
+  # console output through the log listener thread, with the arguments of print()
+  def echo(self, *values) -> None:
+    self.console.info(' '.join(str(value) for value in values))
+
+  # when TwitchLiveCheck is used without main()
+  def start_console(self) -> None:
+    if self.console.handlers == []:
+      console_handler = logging.StreamHandler(sys.stdout)
+      console_handler.setFormatter(logging.Formatter('%(message)s'))
+      queue_logger(self.console, console_handler)
+
+  # offline streamers after every check with self.summary_interval = 0. otherwise only the summary at the interval, state changes are printed when they happen
+  def print_status(self) -> None:
+    if self.summary_interval == 0:
+      if len(self.offline) > 0:
+        self.echo('', sorted(self.offline), 'is offline. Check again in', self.tick(), 'seconds.')
+      return
+    if time.time() - self.summary_time < self.summary_interval:
+      return
+    self.summary_time = time.time()
+    self.echo(' {} offline, {} checking quality, {} recording: {}'.format(len(self.offline), len(self.probing), len(self.recording), sorted(self.recording)))
+    if self.post_processor is not None:
+      status = self.post_processor.status()
+      if status['queued'] > 0 or status['running'] != []:
+        self.echo(' post-processing: {} queued, {}'.format(status['queued'], ', '.join('{} {} {}'.format(job['step'], pathlib.Path(job['file']).name, '{:.0%}'.format(job['progress']) if job['progress'] is not None else '') for job in status['running']) or '0 running'))
+
   # consolidate console output and logging functions
   def print_log(self, logger: logging.Logger, log: str, str1: str, str2=None) -> None:
     if str2 == None:
@@ -411,43 +2534,61 @@ class TwitchLiveCheck:
       if str1 == '':
         pass
       else:
-        print(str1)
+        self.echo(str1)
     elif str1 == '':
       if log == 'info':
         logger.info(str2)
       elif log == 'error':
-        print(str2)
+        self.echo(str2)
         logger.error(str2)
       else:
-        print(str2)
+        self.echo(str2)
         logger.warning(str2)
     else:
       if log == 'info':
-        print(str1)
+        self.echo(str1)
         logger.info(str2)
       elif log == 'error':
-        print(str1)
+        self.echo(str1)
         logger.error(str2)
       else:
-        print(str1)
+        self.echo(str1)
         logger.warning(str2)
 
-  def quality_parser(self, m3u8: str) -> list:
-    quality = []
-    m3u8_line_split = m3u8.split('\n')
-    for m3u8_line in m3u8_line_split:
-      if m3u8_line.find('#EXT-X-MEDIA') != -1 and m3u8_line.find('audio_only') == -1:
-        quality.append(m3u8_line.split(',')[2].split('=')[1].replace('"','').replace(' (source)',''))
-    #quality.append(['best', 'worst'])
-    return quality
-
   def terminate_proc(self) -> None:
-    if self.procs != {}:
-      for id in self.procs:
-        self.procs[id].terminate()
-        self.procs[id].poll()
+    for proc, terminate_time, journal_id, file in self.retiring:
+      proc.terminate()
+      if journal_id is not None:
+        self.journal.finish(journal_id, -15)
+      self.post_process(file, run=False)   # saved for the next start
+    if len(self.recording) > 0:
+      for id in list(self.recording):
+        state = self.streamers[id]
+        state.proc.terminate()
+        state.proc.poll()
+        if 'journal_id' in (state.record_info or {}):
+          self.journal.finish(state.record_info['journal_id'], -15)
+        if state.record_info is not None:
+          self.post_process(state.record_info['file'], run=False)
       self.print_log(self.logger, 'info', ' subprocess terminated', 'subprocess terminated')
 
+# log record as one json line. the traceback is already in the message of a QueueHandler record
+class JsonFormatter(logging.Formatter):
+  def format(self, record: logging.LogRecord) -> str:
+    entry = {'time': self.formatTime(record), 'name': record.name, 'level': record.levelname.upper(), 'message': record.getMessage()}   # streamlink renames the levels in lowercase
+    return json.dumps(entry, ensure_ascii=False)
+
+# the handler runs on a QueueListener thread, so a slow terminal or disk doesn't stall the check loop
+def queue_logger(logger: logging.Logger, handler: logging.Handler) -> logging.handlers.QueueListener:
+  log_queue = queue.SimpleQueue()
+  logger.addHandler(logging.handlers.QueueHandler(log_queue))
+  logger.setLevel(logging.INFO)
+  logger.propagate = False
+  listener = logging.handlers.QueueListener(log_queue, handler)
+  listener.start()
+  atexit.register(listener.stop)   # registered before the exit functions of run(), so their messages are written too
+  return listener
+
 def parsing_arguments() -> argparse.Namespace:
   parser = argparse.ArgumentParser()
   parser.add_argument("-v", "--version", action="store_true", help="See the version")
@@ -459,11 +2600,26 @@ def parsing_arguments() -> argparse.Namespace:
   parser.add_argument("-m", "--check-max", type=int, help="Enter the number of times to check the recording quality")
   parser.add_argument("-p", "--root-path", type=pathlib.Path, help="Enter the recording path")
   parser.add_argument("-d", "--debug", action="store_true", help="Set the logging option")
+  parser.add_argument("-jl", "--json-log", action="store_true", help="Set the json log option")
+  parser.add_argument("-si", "--summary-interval", type=float, help="Enter interval (in seconds) of the console summary")
   parser.add_argument("-lf", "--legacy-function", action="store_true", help="Set the legacy option")
   parser.add_argument("-c", "--config", type=pathlib.Path, help="Enter the config file path")
   parser.add_argument("-qt", "--quality-in-title", action="store_true", help="Set the quality in title option")
   parser.add_argument("-co", "--custom-options", type=str, help="Enter the custom options")
   parser.add_argument("-a", "--oauth", type=str, help="Enter the oauth token")
+  parser.add_argument("-ae", "--async-engine", action="store_true", help="Set the asyncio engine option")
+  parser.add_argument("-mp", "--metrics-port", type=int, help="Enter the port of the metrics endpoint")
+  parser.add_argument("-sj", "--state-journal", action="store_true", help="Set the state journal option")
+  parser.add_argument("-cp", "--control-port", type=int, help="Enter the port of the control api")
+  parser.add_argument("-rc", "--recorder", type=str, choices=['streamlink', 'native'], help="Enter the recorder")
+  parser.add_argument("-rp", "--recorder-pool", type=int, help="Enter the number of streamlink recorders started in advance")
+  parser.add_argument("-dh", "--direct-hls", action="store_true", help="Set the direct hls option")
+  parser.add_argument("-ss", "--shard-store", type=pathlib.Path, help="Enter the path of the shard store shared by several instances")
+  parser.add_argument("-es", "--eventsub", type=str, help="Enter the EventSub user access token")
+  parser.add_argument("-uq", "--upgrade-quality", action="store_true", help="Set the upgrade quality option")
+  parser.add_argument("-rm", "--remux", action="store_true", help="Set the remux option")
+  parser.add_argument("-ap", "--archive-path", type=pathlib.Path, help="Enter the archive path of finished recordings")
+  parser.add_argument("-pw", "--post-workers", type=int, help="Enter the number of finished recordings processed at the same time")
   args = parser.parse_args()
   return args
 
@@ -498,6 +2654,10 @@ def assign_args(args: argparse.Namespace, twitch_check: TwitchLiveCheck) -> Twit
     twitch_check.root_path = args.root_path
   if args.debug:
     twitch_check.traceback_log = True
+  if args.json_log:
+    twitch_check.json_log = True
+  if args.summary_interval != None:
+    twitch_check.summary_interval = args.summary_interval
   if args.legacy_function:
     twitch_check.legacy_func = True
   if args.quality_in_title:
@@ -506,6 +2666,33 @@ def assign_args(args: argparse.Namespace, twitch_check: TwitchLiveCheck) -> Twit
     twitch_check.custom_options = args.custom_options
   if args.oauth != None:
     twitch_check.oauth = args.oauth
+  if args.async_engine:
+    twitch_check.async_engine = True
+  if args.metrics_port != None:
+    twitch_check.metrics_port = args.metrics_port
+  if args.recorder != None:
+    twitch_check.recorder = args.recorder
+  if args.direct_hls:
+    twitch_check.direct_hls = True
+  if args.eventsub != None:
+    twitch_check.eventsub = True
+    twitch_check.eventsub_token = args.eventsub
+  if args.upgrade_quality:
+    twitch_check.upgrade_quality = True
+  if args.recorder_pool != None:
+    twitch_check.recorder_pool = args.recorder_pool
+  if args.shard_store != None:
+    twitch_check.shard_store = args.shard_store
+  if args.control_port != None:
+    twitch_check.control_port = args.control_port
+  if args.state_journal:
+    twitch_check.state_journal = True
+  if args.remux:
+    twitch_check.remux = True
+  if args.archive_path != None:
+    twitch_check.archive_path = args.archive_path
+  if args.post_workers != None:
+    twitch_check.post_workers = args.post_workers
   return twitch_check
 
 def main(argv) -> None:
@@ -515,19 +2702,14 @@ def main(argv) -> None:
   file_logger = logging.getLogger(name='TwitchLiveCheck')
   file_logger.setLevel(logging.INFO)
 
-  # stream logger for future
-  '''stream_logger = logging.getLogger(name='terminal')
-  stream_formatter = logging.Formatter('%(message)s')
-  stream_handler = logging.StreamHandler()
-  stream_handler.setFormatter(stream_formatter)
-  stream_logger.addHandler(stream_handler)'''
-  
   args = parsing_arguments()
   if args.version:
     print("TwitchLiveCheck", __version__)
     sys.exit()
 
-  twitch_check = assign_args(args, TwitchLiveCheck())
+  twitch_check = TwitchLiveCheck()
+  twitch_check.start_console()
+  twitch_check = assign_args(args, twitch_check)
 
   if twitch_check.config_path != '':
     config = twitch_check.dynamic_import(twitch_check.config_path, twitch_check.logger)
@@ -536,12 +2718,12 @@ def main(argv) -> None:
     del config
   
   if twitch_check.traceback_log:
-    file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    file_handler = logging.FileHandler(filename='{}/{}-{}.log'.format(exec_dir, datetime.datetime.now().strftime("%Y%m%d-%Hh%Mm%Ss"), getpid()), mode='a', encoding='utf-8')
+    file_formatter = JsonFormatter() if twitch_check.json_log else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler(filename='{}/{}-{}.{}'.format(exec_dir, datetime.datetime.now().strftime("%Y%m%d-%Hh%Mm%Ss"), getpid(), 'jsonl' if twitch_check.json_log else 'log'), mode='a', encoding='utf-8')
     file_handler.setFormatter(file_formatter)
-    file_logger.addHandler(file_handler)
-    print("log file directory:", exec_dir)
-    print("pid: ", getpid())
+    queue_logger(file_logger, file_handler)
+    twitch_check.echo("log file directory:", exec_dir)
+    twitch_check.echo("pid: ", getpid())
     file_logger.info('logging started')
     file_logger.info('TwitchLiveCheck version: {}'.format(__version__))
     file_logger.info('python version: {}'.format(sys.version))
@@ -557,4 +2739,7 @@ def main(argv) -> None:
     twitch_check.run()
 
 if __name__ == '__main__':
-  main(sys.argv[1:])
\ No newline at end of file
+  if sys.argv[1:2] == ['--recorder-worker']:
+    recorder_worker()
+  else:
+    main(sys.argv[1:])
\ No newline at end of file
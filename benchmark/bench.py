@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*-coding: utf-8 -*-
+
+# detection latency and per-poll cost of TwitchLiveCheck against the local mock twitch.
+# example: python benchmark/bench.py -n 10 100 1000 5000 -d 60
+
+import sys, time, json, pathlib, tempfile, socket, threading, argparse, contextlib, io
+import multiprocessing
+import requests
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+from TwitchLiveCheck import TwitchLiveCheck
+from mock_twitch import Schedule, serve
+
+
+# recorder that does nothing. it ends when the stream of the schedule ends
+class FakeRecorder:
+  def __init__(self, schedule: Schedule, id) -> None:
+    self.schedule = schedule
+    self.id = id
+    self.returncode = None
+
+  def poll(self):
+    if self.returncode is None and self.schedule.is_live(self.id) is False:
+      self.returncode = 0
+    return self.returncode
+
+  def wait(self, timeout=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while self.poll() is None and (deadline is None or time.monotonic() < deadline):
+      time.sleep(0.1)
+    return self.returncode
+
+  def terminate(self) -> None:
+    self.returncode = -15
+
+  def kill(self) -> None:
+    self.returncode = -9
+
+
+class BenchLiveCheck(TwitchLiveCheck):
+  def __init__(self, schedule: Schedule) -> None:
+    super().__init__()
+    self.schedule = schedule
+    self.record_times = dict()
+    self.poll_cycles = 0
+
+  def launch_recorder(self, id, file_path: pathlib.Path):
+    self.record_times.setdefault(id, time.time())
+    return FakeRecorder(self.schedule, id)
+
+  def fetch_streams(self) -> list:
+    self.poll_cycles += 1
+    return super().fetch_streams()
+
+
+def free_port() -> int:
+  with socket.socket() as sock:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+
+def rss_mb() -> float:
+  status = pathlib.Path('/proc/self/status')
+  if status.is_file():
+    for line in status.read_text().split('\n'):
+      if line.startswith('VmRSS:'):
+        return int(line.split()[1]) / 1024
+  import resource
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def percentile(values: list, percent: float) -> float:
+  if values == []:
+    return float('nan')
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+# run one TwitchLiveCheck against the mock server and put the result into result_queue
+def run_scale(args: argparse.Namespace, streamers: int, port: int, start: float, result_queue) -> None:
+  schedule = Schedule(streamers, start, args.duration, args.live_ratio, args.seed)
+  check = BenchLiveCheck(schedule)
+  check.streamerID = ' '.join(schedule.logins)
+  check.quality = args.quality
+  check.refresh = args.refresh
+  check.root_path = tempfile.mkdtemp(prefix='twitch_bench_')
+  check.client_id = 'bench'
+  check.client_secret = 'bench'
+  check.async_engine = args.engine == 'async'
+  check.upgrade_quality = args.upgrade_quality
+  check.oauth_url = 'http://127.0.0.1:{}/oauth2'.format(port)
+  check.helix_url = 'http://127.0.0.1:{}/helix'.format(port)
+  check.gql_url = 'http://127.0.0.1:{}/gql'.format(port)
+  check.usher_url = 'http://127.0.0.1:{}/hls/{{}}.m3u8'.format(port)
+  check.host_limits = {'127.0.0.1:{}'.format(port): 16}
+
+  with contextlib.redirect_stdout(io.StringIO()) if args.verbose is False else contextlib.nullcontext():
+    threading.Thread(target=check.run, name='bench', daemon=True).start()
+    cpu_start = time.process_time()
+    time.sleep(max(0, start + args.duration - time.time()))
+    cpu_time = time.process_time() - cpu_start
+
+  latency = [check.record_times[id] - schedule.live[id][0] for id in check.record_times if id in schedule.live]
+  expected = [id for id in schedule.live if schedule.live[id][0] < start + args.duration - args.refresh * 2]
+  stats = requests.get('http://127.0.0.1:{}/stats'.format(port), timeout=5).json()
+  minutes = args.duration / 60
+  result_queue.put({
+    'streamers': streamers,
+    'detected': len(latency),
+    'missed': len([id for id in expected if id not in check.record_times]),
+    'latency_p50': percentile(latency, 50),
+    'latency_p90': percentile(latency, 90),
+    'latency_p99': percentile(latency, 99),
+    'latency_max': max(latency) if latency != [] else float('nan'),
+    'helix_rpm': stats.get('/helix/streams', 0) / minutes,
+    'gql_rpm': stats.get('/gql', 0) / minutes,
+    'usher_rpm': stats.get('/hls', 0) / minutes,
+    'too_many_requests': stats.get('429', 0),
+    'poll_cycles': check.poll_cycles,
+    'cpu_ms_per_cycle': cpu_time * 1000 / max(1, check.poll_cycles),
+    'rss_mb': rss_mb(),
+  })
+
+def bench(args: argparse.Namespace, streamers: int) -> dict:
+  port = free_port()
+  start = time.time() + 2
+  server = multiprocessing.Process(target=serve, args=(port, streamers, start, args.duration, args.live_ratio, args.seed, args.latency, args.error_rate, args.rate_limit, args.quality_delay), daemon=True)
+  server.start()
+  for _ in range(50):
+    try:
+      socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+      break
+    except OSError:
+      time.sleep(0.1)
+  result_queue = multiprocessing.Queue()
+  client = multiprocessing.Process(target=run_scale, args=(args, streamers, port, start, result_queue), daemon=True)
+  client.start()
+  result = result_queue.get(timeout=args.duration + 60)
+  client.terminate()
+  server.terminate()
+  return result
+
+def print_table(results: list) -> None:
+  columns = ['streamers', 'detected', 'missed', 'latency_p50', 'latency_p90', 'latency_p99', 'latency_max', 'helix_rpm', 'gql_rpm', 'usher_rpm', 'too_many_requests', 'cpu_ms_per_cycle', 'rss_mb']
+  print(' '.join('{:>12}'.format(column[:12]) for column in columns))
+  for result in results:
+    print(' '.join('{:>12.3f}'.format(result[column]) if isinstance(result[column], float) else '{:>12}'.format(result[column]) for column in columns))
+
+def parsing_arguments() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(description='TwitchLiveCheck benchmark with the local mock twitch')
+  parser.add_argument("-n", "--streamers", type=int, nargs='+', default=[10, 100, 1000, 5000], help="Enter the numbers of streamers")
+  parser.add_argument("-d", "--duration", type=float, default=60, help="Enter the length (in seconds) of each run")
+  parser.add_argument("-lr", "--live-ratio", type=float, default=0.1, help="Enter the ratio of streamers going live")
+  parser.add_argument("-l", "--latency", type=float, default=0.02, help="Enter the latency (in seconds) of the mock server")
+  parser.add_argument("-e", "--error-rate", type=float, default=0.0, help="Enter the probability of 429 responses")
+  parser.add_argument("-rl", "--rate-limit", type=int, default=800, help="Enter the helix rate limit (points per minute)")
+  parser.add_argument("-qd", "--quality-delay", type=float, default=0.0, help="Enter the delay (in seconds) until the source quality appears")
+  parser.add_argument("-q", "--quality", type=str, default='720p60', help="Enter the recording quality")
+  parser.add_argument("-r", "--refresh", type=float, default=1.5, help="Enter interval (in seconds) to check for streams")
+  parser.add_argument("-en", "--engine", type=str, default='sync', choices=['sync', 'async'], help="Enter the engine")
+  parser.add_argument("-uq", "--upgrade-quality", action="store_true", help="Record the best quality until the recording quality appears")
+  parser.add_argument("-s", "--seed", type=int, default=0, help="Enter the random seed of the schedule")
+  parser.add_argument("-j", "--json", action="store_true", help="Print the results as json")
+  parser.add_argument("-v", "--verbose", action="store_true", help="Show the output of TwitchLiveCheck")
+  return parser.parse_args()
+
+def main() -> None:
+  args = parsing_arguments()
+  results = []
+  for streamers in args.streamers:
+    results.append(bench(args, streamers))
+    if args.json:
+      print(json.dumps(results[-1]))
+  if args.json is False:
+    print_table(results)
+
+if __name__ == '__main__':
+  main()
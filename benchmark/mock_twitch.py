@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*-coding: utf-8 -*-
+
+# local stand-in for id.twitch.tv, helix, gql and usher. streamers go live and offline on a schedule
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import time, json, random, threading, argparse
+
+
+class Schedule:
+  def __init__(self, streamers: int, start: float, duration: float, live_ratio=0.1, seed=0) -> None:
+    rng = random.Random(seed)
+    self.logins = ['streamer{}'.format(num) for num in range(streamers)]
+    self.live = dict()   # {login: (online time, offline time)}
+    for login in rng.sample(self.logins, max(1, int(streamers * live_ratio))):
+      online = start + rng.uniform(duration * 0.1, duration * 0.7)
+      self.live[login] = (online, online + rng.uniform(duration * 0.3, duration))
+
+  def is_live(self, login, now=None) -> bool:
+    now = time.time() if now is None else now
+    return login in self.live and self.live[login][0] <= now < self.live[login][1]
+
+
+class MockTwitchServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, schedule: Schedule, latency=0.0, error_rate=0.0, rate_limit=800, quality_delay=0.0) -> None:
+    super().__init__(address, MockTwitchHandler)
+    self.schedule = schedule
+    self.latency = latency   # (seconds) added to every response
+    self.error_rate = error_rate   # probability of 429 for helix requests
+    self.rate_limit = rate_limit   # helix points per minute
+    self.quality_delay = quality_delay   # (seconds) only 480p is available for this long after going live
+    self.tokens = rate_limit
+    self.updated = time.time()
+    self.counts = dict()
+    self.lock = threading.Lock()
+
+  def count(self, endpoint) -> None:
+    with self.lock:
+      self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+  # helix token bucket. returns (allowed, remaining, reset time)
+  def take_token(self) -> tuple:
+    with self.lock:
+      now = time.time()
+      self.tokens = min(self.rate_limit, self.tokens + (now - self.updated) * self.rate_limit / 60)
+      self.updated = now
+      reset = int(now + (self.rate_limit - self.tokens) * 60 / self.rate_limit) + 1
+      if self.tokens < 1:
+        return False, 0, reset
+      self.tokens -= 1
+      return True, int(self.tokens), reset
+
+
+class MockTwitchHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args) -> None:
+    pass
+
+  def send(self, status, body, content_type='application/json', headers=None) -> None:
+    if isinstance(body, (dict, list)):
+      body = json.dumps(body)
+    body = body.encode() if isinstance(body, str) else body
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    for key in (headers or {}):
+      self.send_header(key, headers[key])
+    self.end_headers()
+    self.wfile.write(body)
+
+  def read_body(self) -> bytes:
+    return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+  def do_POST(self) -> None:
+    self.read_body()
+    if self.server.latency > 0:
+      time.sleep(self.server.latency)
+    path = urlsplit(self.path).path
+    self.server.count(path)
+    if path == '/oauth2/token':
+      self.send(200, {'access_token': 'mock-app-token', 'expires_in': 5000000, 'token_type': 'bearer'})
+    elif path == '/oauth2/revoke':
+      self.send(200, '')
+    elif path == '/gql':
+      value = json.dumps({'adblock': False, 'expires': int(time.time()) + 1200, 'channel': 'mock'})
+      self.send(200, {'data': {'streamPlaybackAccessToken': {'value': value, 'signature': 'mock', '__typename': 'PlaybackAccessToken'}}})
+    else:
+      self.send(404, {'message': 'not found'})
+
+  def do_GET(self) -> None:
+    if self.server.latency > 0:
+      time.sleep(self.server.latency)
+    url = urlsplit(self.path)
+    query = parse_qs(url.query)
+    schedule = self.server.schedule
+    if url.path.startswith('/hls/'):
+      self.server.count('/hls')
+    elif url.path.startswith('/variant/'):
+      self.server.count('/variant')
+    elif url.path.startswith('/segment/'):
+      self.server.count('/segment')
+    else:
+      self.server.count(url.path)
+
+    if url.path == '/oauth2/validate':
+      self.send(200, {'client_id': 'mock', 'expires_in': 5000000})
+    elif url.path == '/stats':
+      self.send(200, self.server.counts)
+    elif url.path == '/helix/streams':
+      allowed, remaining, reset = self.server.take_token()
+      headers = {'Ratelimit-Limit': str(self.server.rate_limit), 'Ratelimit-Remaining': str(remaining), 'Ratelimit-Reset': str(reset)}
+      if allowed is False or random.random() < self.server.error_rate:
+        self.server.count('429')
+        self.send(429, {'message': 'Too Many Requests'}, headers=headers)
+        return
+      data = [{'user_login': login, 'title': 'mock stream', 'game_name': 'Just Chatting'} for login in query.get('user_login', []) if schedule.is_live(login)]
+      self.send(200, {'data': data}, headers=headers)
+    elif url.path == '/helix/users':
+      self.send(200, {'data': [{'login': login, 'id': login.replace('streamer', '')} for login in query.get('login', [])]})
+    elif url.path == '/helix/channels':
+      self.send(200, {'data': [{'title': 'mock stream', 'game_name': 'Just Chatting'}]})
+    elif url.path.startswith('/hls/'):
+      login = url.path.split('/')[-1].replace('.m3u8', '')
+      if schedule.is_live(login) is False:
+        self.send(404, '[]')
+        return
+      self.send(200, self.master_playlist(login), 'application/vnd.apple.mpegurl')
+    elif url.path.startswith('/variant/'):
+      login = url.path.split('/')[-2]
+      if schedule.is_live(login) is False:
+        self.send(404, '')
+        return
+      self.send(200, self.media_playlist(login), 'application/vnd.apple.mpegurl')
+    elif url.path.startswith('/segment/'):
+      self.send(200, b'\x47' * 188 * 10, 'video/mp2t')
+    else:
+      self.send(404, {'message': 'not found'})
+
+  def master_playlist(self, login) -> str:
+    qualities = [('480p30', '852x480', 1400000), ('audio_only', None, 160000)]
+    if time.time() - self.server.schedule.live[login][0] >= self.server.quality_delay:
+      qualities = [('1080p60 (source)', '1920x1080', 8000000), ('720p60', '1280x720', 3400000)] + qualities
+    lines = ['#EXTM3U', '#EXT-X-TWITCH-INFO:NODE="mock",SERVING-ID="mock"']
+    for name, resolution, bandwidth in qualities:
+      group = name.replace(' (source)', '')
+      lines.append('#EXT-X-MEDIA:TYPE=VIDEO,GROUP-ID="{}",NAME="{}",AUTOSELECT=YES,DEFAULT=YES'.format(group, name))
+      stream_inf = '#EXT-X-STREAM-INF:BANDWIDTH={},CODECS="avc1.64002A,mp4a.40.2",VIDEO="{}"'.format(bandwidth, group)
+      lines.append(stream_inf + (',RESOLUTION={},FRAME-RATE=60.000'.format(resolution) if resolution else ''))
+      lines.append('http://{}:{}/variant/{}/{}.m3u8'.format(*self.server.server_address, login, group))
+    return '\n'.join(lines) + '\n'
+
+  def media_playlist(self, login) -> str:
+    sequence = int(time.time() - self.server.schedule.live[login][0]) // 2
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:{}'.format(max(0, sequence - 5))]
+    for num in range(max(0, sequence - 5), sequence + 1):
+      lines.extend(['#EXTINF:2.000,live', '/segment/{}/{}.ts'.format(login, num)])
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port: int, streamers: int, start: float, duration: float, live_ratio=0.1, seed=0, latency=0.0, error_rate=0.0, rate_limit=800, quality_delay=0.0) -> None:
+  schedule = Schedule(streamers, start, duration, live_ratio, seed)
+  server = MockTwitchServer(('127.0.0.1', port), schedule, latency, error_rate, rate_limit, quality_delay)
+  server.serve_forever()
+
+def parsing_arguments() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(description='local stand-in for the twitch endpoints used by TwitchLiveCheck')
+  parser.add_argument("-p", "--port", type=int, default=8080, help="Enter the port")
+  parser.add_argument("-n", "--streamers", type=int, default=100, help="Enter the number of streamers")
+  parser.add_argument("-d", "--duration", type=float, default=60, help="Enter the length (in seconds) of the schedule")
+  parser.add_argument("-lr", "--live-ratio", type=float, default=0.1, help="Enter the ratio of streamers going live")
+  parser.add_argument("-l", "--latency", type=float, default=0.0, help="Enter the latency (in seconds) of every response")
+  parser.add_argument("-e", "--error-rate", type=float, default=0.0, help="Enter the probability of 429 responses")
+  parser.add_argument("-r", "--rate-limit", type=int, default=800, help="Enter the helix rate limit (points per minute)")
+  parser.add_argument("-qd", "--quality-delay", type=float, default=0.0, help="Enter the delay (in seconds) until the source quality appears")
+  parser.add_argument("-s", "--seed", type=int, default=0, help="Enter the random seed of the schedule")
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  args = parsing_arguments()
+  print('mock twitch on http://127.0.0.1:{}'.format(args.port))
+  serve(args.port, args.streamers, time.time(), args.duration, args.live_ratio, args.seed, args.latency, args.error_rate, args.rate_limit, args.quality_delay)
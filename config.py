@@ -1,15 +1,39 @@
 
-streamerID = ''   # You can enter up to 100 streamers(api maximum limit), separated by spaces example: "username1 username2 ... "
+streamerID = ''   # You can enter streamers separated by spaces. they are checked in batches of 100(api maximum limit). example: "username1 username2 ... "
 quality_by_streamer = {}   # You can enter the streamer-specific quality if necessary. Don't overlap self.streamerID. example: {"username 1":"quality 1", "username 2":"quality 2"}
 quality = 'best'   # Set recording quality.
 refresh = 1.5   # Check interval (in seconds) to check for streams. you can enter decimals
 check_max = 20   # Set the number of times to check the recording quality. If there's no recording quality beyond the number of searches, change the quality to best. you must enter an integer
 root_path = r''   # Set recording path. do not delete thr 'r' character
 traceback_log = False   # if True, save traceback log file
+json_log = False   # if True, write the log file as json lines
+summary_interval = 60   # (seconds) the console shows state changes and a summary at this interval. 0 : show the offline streamers after every check
 quality_in_title = False   # if True, add quality info to title
 
 custom_options = ''   # cli options for streamlink, separated by spaces. example: 'option1 value1 option2 value2 ... '
 legacy_func = False   # if True, use legacy quality check functions
+pool_size = 10   # number of keep-alive connections kept for each twitch host
+http_retries = 2   # number of retries for connection errors and 5xx responses
+async_engine = False   # if True, run helix polling, quality probing and process checking as concurrent asyncio tasks
+probe_workers = 8   # number of quality checks running at the same time
+cache_path = r''   # set the directory for cache files. if empty, use root_path. do not delete the 'r' character
+max_recordings = 0   # maximum number of recordings at the same time. 0 : no limit
+metrics_port = 0   # if not 0, serve prometheus metrics on http://127.0.0.1:metrics_port/metrics
+token_cache = True   # if True, keep the app access token in app_token.json of cache_path and reuse it after restart and in other instances. it is not revoked at exit
+state_journal = False   # if True, keep tokens, running recordings and the recording history in state.db of cache_path. after a crash, recordings are reattached or started again right away
+control_port = 0   # if not 0, add and remove streamers or change their quality on http://127.0.0.1:control_port/streamers without restart
+recorder = 'streamlink'   # 'streamlink' : record with streamlink processes, 'native' : record in this process with one shared thread pool
+recorder_pool = 0   # number of streamlink recorders started in advance with streamlink imported. need the streamlink python package. 0 : start streamlink when the stream goes live
+direct_hls = False   # if True, pass the variant playlist found by the quality check to streamlink as hls:// url. twitch options of streamlink(--twitch-disable-ads, ...) don't apply to it
+shard_store = r''   # set the path of a sqlite file shared by several TwitchLiveCheck instances with the same streamers. each streamer is checked and recorded by one instance. if empty, check every streamer. do not delete the 'r' character
+eventsub = False   # if True, detect streams with EventSub WebSocket(stream.online) and check them with helix less often. need websocket-client
+eventsub_token = ''   # user access token for EventSub WebSocket. it must be created with client_id
+upgrade_quality = False   # if True, record the best available quality right away when the recording quality is not found, and switch to a new file when it appears. not with legacy_func
+remux = False   # if True, remux finished recordings to mp4 with ffmpeg. the .ts file is deleted when it succeeds. need ffmpeg
+archive_path = r''   # move finished recordings to archive_path/username. if empty, keep them in root_path. do not delete the 'r' character
+post_workers = 1   # number of finished recordings remuxed or moved at the same time
+post_nice = 10   # nice level of the remux and move. on windows, below normal priority(idle with 19)
+post_pause = 0   # remux and move wait while this many or more recordings are running. 0 : no wait
 
 oauth = ''   # your OAuth token.
 client_id = ''   # Client ID
@@ -18,7 +42,7 @@ client_secret = ''   # Client Secret
 twitch_live_check_path = r''   # set the TwitchLiveCheck path. do not delete the 'r' character
 
 # --- Do not edit --------------------------------------------------------------
-__version__ = 0.3
+__version__ = 0.4
 
 
 if __name__ == '__main__':